@@ -0,0 +1,99 @@
+"""Shared helpers for the benchmark scripts.
+
+The server is a flat set of modules (``app``, ``models``, ``config``) that read
+their settings from the environment at import time, so every benchmark points
+the env at a throwaway directory *before* importing anything from ``server/``.
+"""
+import os, sys, socket, subprocess, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT, "server")
+WORKER_DIR = os.path.join(ROOT, "worker")
+
+
+def temp_server_env(prefix="dtrain_bench_", database_url=None):
+    """Point the server config at a fresh temp dir and return that dir."""
+    tmp = tempfile.mkdtemp(prefix=prefix)
+    os.environ["DATABASE_URL"] = database_url or "sqlite:///" + os.path.join(tmp, "bench.db")
+    os.environ["JOB_BUNDLES_FOLDER"] = os.path.join(tmp, "job_bundles")
+    os.environ["UPLOAD_FOLDER"] = os.path.join(tmp, "uploads")
+    os.environ["MODEL_UPLOADS_FOLDER"] = os.path.join(tmp, "model_uploads")
+    os.environ["LOG_STORE_FOLDER"] = os.path.join(tmp, "job_logs")
+    os.environ["METRICS_FOLDER"] = os.path.join(tmp, "job_metrics")
+    for key in ("JOB_BUNDLES_FOLDER", "UPLOAD_FOLDER", "MODEL_UPLOADS_FOLDER", "LOG_STORE_FOLDER", "METRICS_FOLDER"):
+        os.makedirs(os.environ[key], exist_ok=True)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+    return tmp
+
+
+def make_app(prefix="dtrain_bench_", database_url=None):
+    """Create the Flask app + SocketIO against a temp database."""
+    tmp = temp_server_env(prefix, database_url)
+    from app import create_app
+    app, socketio = create_app()
+    return app, socketio, tmp
+
+
+def auth_headers(app):
+    return {"Authorization": f"Bearer {app.config['WORKER_SHARED_TOKEN']}"}
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+# Runs the real eventlet server, so concurrent clients exercise the same greenlet
+# scheduling and database contention as a deployment does.
+_SERVE = (
+    "import sys\n"
+    "from app import create_app\n"
+    "app, socketio = create_app()\n"
+    "socketio.run(app, host='127.0.0.1', port=int(sys.argv[1]), log_output=False)\n"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(prefix="dtrain_bench_", database_url=None, extra_env=None, timeout=30, workers=None):
+    """Launch the server in a subprocess against a temp dir; returns (proc, base_url, tmp).
+
+    With ``workers`` the production setup (gunicorn + eventlet, see wsgi.py)
+    is started with that many processes instead of the single dev process.
+    """
+    tmp = temp_server_env(prefix, database_url)
+    env = dict(os.environ, **(extra_env or {}))
+    port = free_port()
+    if workers:
+        env.update(WEB_WORKERS=str(workers), BIND_HOST="127.0.0.1", PORT=str(port))
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+    else:
+        cmd = [sys.executable, "-c", _SERVE, str(port)]
+    proc = subprocess.Popen(cmd, cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc, f"http://127.0.0.1:{port}", tmp
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
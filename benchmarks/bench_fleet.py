@@ -0,0 +1,302 @@
+"""End-to-end load test: a fleet of simulated worker agents against a live server.
+
+    python benchmarks/bench_fleet.py --agents 16 --jobs 64 --job-seconds 5 --log-rate 200
+    python benchmarks/bench_fleet.py --save baseline.json
+    python benchmarks/bench_fleet.py --compare baseline.json      # after a change
+
+The server runs in a subprocess against a temp database. Every simulated agent
+is the real ``worker/agent.py`` code path, with only Docker stubbed out:
+
+* it registers, heartbeats and long-polls ``claim_job`` like ``agent.main``;
+* ``run_job`` downloads and extracts the bundle through ``BundleCache``;
+* a fake container prints ``--log-rate`` lines/sec for ``--job-seconds``,
+  with an ``Epoch N: loss=..`` line every ``--metric-every`` lines. These go
+  through the agent's ``LogShipper`` / ``MetricShipper``;
+* the container leaves an ``--artifact-kb`` model file that ``ArtifactCollector``
+  uploads in chunks.
+
+Agents run as threads spread over ``--processes`` processes. The report has:
+
+* jobs/sec, log lines/sec and requests/sec;
+* p50/p99 client-side latency per endpoint (claims include their long-poll wait);
+* growth of the database and of the on-disk log, metric and artifact stores.
+
+``--save`` writes the numbers as JSON and ``--compare`` prints the change
+against such a file, so a scheduling or ingestion change can be measured
+against a baseline.
+"""
+import argparse, io, itertools, json, os, re, sys, threading, time, zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+from _common import start_server, percentile, WORKER_DIR
+
+TOKEN = "changeme-worker-token"
+
+
+def make_bundle(index, extra_kb):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("main.py", f"print('job {index}')\n")
+        if extra_kb:
+            z.writestr("data.bin", os.urandom(extra_kb * 1024))
+    return buf.getvalue()
+
+
+def disk_usage(tmp, database_url):
+    """Bytes used by the SQLite file (+ WAL) and by each on-disk store under ``tmp``."""
+    def size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+    usage = {}
+    if not database_url:
+        db = os.path.join(tmp, "bench.db")
+        usage["database"] = sum(size(db + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(db + suffix))
+    for name, folder in (("logs", "job_logs"), ("metrics", "job_metrics"), ("artifacts", "model_uploads"),
+                         ("bundles", "job_bundles")):
+        usage[name] = size(os.path.join(tmp, folder))
+    return usage
+
+
+# -------- simulated agents (run inside the agent processes) --------
+ID_SEGMENT = re.compile(r"/(\d+|[0-9a-f]{16,})(?=/|$)")
+current_job = threading.local()
+lines_emitted = itertools.count()
+
+
+class FakeContainer:
+    """Stands in for a docker SDK container: ``rate`` log lines/sec for ``seconds``."""
+
+    def __init__(self, job_id, seconds, rate, metric_every):
+        self.job_id = job_id
+        self.seconds = seconds
+        self.rate = rate
+        self.metric_every = metric_every
+        self._stopped = threading.Event()
+
+    def logs(self, stream=True, follow=True):
+        interval = 1.0 / self.rate
+        deadline = time.monotonic() + self.seconds
+        n = 0
+        while time.monotonic() < deadline and not self._stopped.is_set():
+            n += 1
+            next(lines_emitted)
+            if self.metric_every and n % self.metric_every == 0:
+                epoch = n // self.metric_every
+                yield f"Epoch {epoch}: loss={1.0 / epoch:.4f}, acc={1 - 1.0 / (epoch + 1):.4f}\n".encode()
+            else:
+                yield f"[job {self.job_id}] step {n} training...\n".encode()
+            self._stopped.wait(interval)
+
+    def stop(self, timeout=10):
+        self._stopped.set()
+
+    def remove(self, force=False):
+        self._stopped.set()
+
+
+def init_agent_process(args):
+    """Load worker/agent.py with Docker stubbed out and every request timed."""
+    global agent, samples, samples_lock
+    sys.stdout = open(os.devnull, "w")  # the agent prints every log line and upload
+    sys.path.insert(0, WORKER_DIR)
+    import agent
+    samples, samples_lock = defaultdict(list), threading.Lock()
+
+    def extract_model_files(container, outputs_dir, model_patterns=None, code_dir=None):
+        if args.artifact_kb:
+            os.makedirs(outputs_dir, exist_ok=True)
+            with open(os.path.join(outputs_dir, "model.pkl"), "wb") as f:
+                f.write(os.urandom(args.artifact_kb * 1024))
+
+    agent.DOCKER_SDK = True
+    agent.prepare_image = lambda cfg, image_cache, job, workdir, control=None: ("bench-stub:latest", None, None)
+    agent.run_container = lambda tag, **kwargs: FakeContainer(current_job.id, args.job_seconds, args.log_rate,
+                                                              args.metric_every)
+    agent.extract_model_files = extract_model_files
+    agent.remove_image = lambda tag: True
+
+    request = agent.HttpClient.request
+
+    def timed_request(self, method, path, **kwargs):
+        status, start = "error", time.perf_counter()
+        try:
+            resp = request(self, method, path, **kwargs)
+            status = resp.status_code
+            return resp
+        finally:
+            key = f"{method} {ID_SEGMENT.sub('/<id>', path.split('?')[0])}"
+            with samples_lock:
+                samples[key].append((time.perf_counter() - start, status))
+    agent.HttpClient.request = timed_request
+
+
+def agent_cfg(base, name, args, workdir):
+    return {
+        "server_url": base, "token": TOKEN, "worker_name": name,
+        "auto_accept_jobs": True, "max_concurrent_jobs": 1,
+        "claim_wait_sec": args.claim_wait, "heartbeat_interval_sec": 5,
+        "bundle_cache_dir": os.path.join(workdir, "bundles"), "log_spill_dir": os.path.join(workdir, "spill"),
+        "http_pool_maxsize": 64, "http_stats_interval_sec": 0,
+    }
+
+
+def run_agent(base, name, args, workdir, deadline, done):
+    """What ``agent.main`` does with one slot, until the queue is drained or time runs out."""
+    cfg = agent_cfg(base, name, args, workdir)
+    slots = agent.JobSlots(1)
+    heartbeat = agent.Heartbeat(cfg, slots).start()
+    ctx = agent.WorkerContext(slots, heartbeat, None, agent.BundleCache(cfg), agent.ArtifactCollector(cfg))
+    agent.api_post(cfg, "/api/workers/register", {"name": name, "slots_total": 1, "slots_free": 1})
+    while time.monotonic() < deadline:
+        job = agent.claim_job(cfg, slots)
+        if not job:
+            break  # every job is queued up front, so an empty long poll means we're done
+        current_job.id = job["id"]
+        agent.run_job(cfg, job, ctx, heartbeat.hold(job["id"]))
+        done.append(job["id"])
+
+
+def agent_process(base, names, args, deadline):
+    """Run one thread per agent name; returns (jobs run, lines emitted, {endpoint: [(seconds, status)]})."""
+    workdir = os.path.join(args.tmp, f"agents_{os.getpid()}")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)  # run_job puts outputs/ under the cwd
+    done = []
+    threads = [threading.Thread(target=run_agent, args=(base, name, args, os.path.join(workdir, name), deadline, done))
+               for name in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(done), next(lines_emitted), dict(samples)
+
+
+# -------- driver --------
+def job_statuses(base):
+    counts, cursor = defaultdict(int), None
+    while True:
+        r = requests.get(f"{base}/api/jobs", params={"limit": 500, "cursor": cursor}, timeout=60)
+        r.raise_for_status()
+        for job in r.json():
+            counts[job["status"]] += 1
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            return dict(counts)
+
+
+def run(args):
+    proc, base, tmp = start_server("dtrain_fleet_", args.database_url)
+    args.tmp = tmp
+    try:
+        for i in range(args.jobs):
+            requests.post(f"{base}/api/jobs", data={"name": f"fleet-{i}"}, timeout=60,
+                          files={"file": ("bundle.zip", make_bundle(i, args.bundle_kb))}).raise_for_status()
+        before = disk_usage(tmp, args.database_url)
+
+        names = [f"fleet-agent-{i}" for i in range(args.agents)]
+        groups = [g for g in (names[p::args.processes] for p in range(args.processes)) if g]
+        start = time.monotonic()
+        with ProcessPoolExecutor(len(groups), initializer=init_agent_process, initargs=(args,)) as pool:
+            results = list(pool.map(agent_process, [base] * len(groups), groups, [args] * len(groups),
+                                    [start + args.max_seconds] * len(groups)))
+        elapsed = time.monotonic() - start
+        after = disk_usage(tmp, args.database_url)
+        statuses = job_statuses(base)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    endpoints = defaultdict(list)
+    for _, _, per_endpoint in results:
+        for key, values in per_endpoint.items():
+            endpoints[key].extend(values)
+    jobs = sum(n for n, _, _ in results)
+    lines = sum(n for _, n, _ in results)
+    return {
+        "config": {k: getattr(args, k) for k in ("agents", "processes", "jobs", "job_seconds", "log_rate",
+                                                 "metric_every", "artifact_kb", "bundle_kb")},
+        "seconds": elapsed,
+        "jobs_run": jobs,
+        "statuses": statuses,
+        "jobs_per_sec": jobs / elapsed,
+        "log_lines_per_sec": lines / elapsed,
+        "requests_per_sec": sum(len(v) for v in endpoints.values()) / elapsed,
+        "endpoints": {key: {"count": len(v),
+                            "p50_ms": percentile([s for s, _ in v], 50) * 1000,
+                            "p99_ms": percentile([s for s, _ in v], 99) * 1000,
+                            "errors": sum(1 for _, status in v if status == "error" or status >= 400)}
+                      for key, v in sorted(endpoints.items())},
+        "disk_bytes": {name: {"before": before[name], "after": after[name]} for name in after},
+    }
+
+
+def change(new, old):
+    return f"{(new - old) / old * 100:+7.1f}%" if old else "       -"
+
+
+def report(result, baseline=None):
+    base = baseline or {}
+    print(f"{result['jobs_run']} jobs in {result['seconds']:.1f}s, final statuses {result['statuses']}")
+    print(f"{'':<34}{'value':>12}" + (f"{'baseline':>12}{'change':>9}" if baseline else ""))
+    for key in ("jobs_per_sec", "log_lines_per_sec", "requests_per_sec"):
+        line = f"{key:<34}{result[key]:>12.1f}"
+        if baseline:
+            line += f"{base[key]:>12.1f}{change(result[key], base[key]):>9}"
+        print(line)
+
+    print(f"\n{'endpoint':<44}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"
+          + (f"{'p50 chg':>9}{'p99 chg':>9}" if baseline else ""))
+    for key, stats in result["endpoints"].items():
+        line = f"{key:<44}{stats['count']:>8}{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['errors']:>8}"
+        old = base.get("endpoints", {}).get(key)
+        if old:
+            line += f"{change(stats['p50_ms'], old['p50_ms']):>9}{change(stats['p99_ms'], old['p99_ms']):>9}"
+        print(line)
+
+    jobs = max(1, result["jobs_run"])
+    print(f"\n{'storage':<34}{'before KB':>10}{'after KB':>10}{'KB/job':>10}" + (f"{'KB/job chg':>12}" if baseline else ""))
+    for name, size in result["disk_bytes"].items():
+        per_job = (size["after"] - size["before"]) / jobs
+        line = f"{name:<34}{size['before'] / 1024:>10.0f}{size['after'] / 1024:>10.0f}{per_job / 1024:>10.1f}"
+        old = base.get("disk_bytes", {}).get(name)
+        if old:
+            old_per_job = (old["after"] - old["before"]) / max(1, base["jobs_run"])
+            line += f"{change(per_job, old_per_job):>12}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=16, help="simulated worker agents (one slot each)")
+    parser.add_argument("--processes", type=int, default=4, help="processes the agents are spread over")
+    parser.add_argument("--jobs", type=int, default=64)
+    parser.add_argument("--job-seconds", type=float, default=5, help="how long each fake container runs")
+    parser.add_argument("--log-rate", type=float, default=200, help="log lines/sec per running job")
+    parser.add_argument("--metric-every", type=int, default=10, help="every Nth line is an 'Epoch N: loss=..' line")
+    parser.add_argument("--artifact-kb", type=int, default=256, help="model file uploaded by every job (0: none)")
+    parser.add_argument("--bundle-kb", type=int, default=64, help="random payload in every job bundle")
+    parser.add_argument("--claim-wait", type=int, default=2, help="long-poll wait of an idle agent")
+    parser.add_argument("--max-seconds", type=float, default=600, help="stop claiming new jobs after this")
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file (disk sizes only cover SQLite)")
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="print changes against results saved with --save")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    result = run(args)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
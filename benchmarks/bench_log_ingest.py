@@ -0,0 +1,55 @@
+"""Log ingestion throughput: one commit per line vs one bulk insert per batch.
+
+    python benchmarks/bench_log_ingest.py --batches 20 --batch-size 500
+
+"before" replays the old ``append_log``-per-line loop directly against the
+session; "after" posts each batch through ``POST /api/jobs/<id>/logs``, so the
+bulk numbers also include request handling overhead.
+"""
+import argparse, os
+
+from _common import make_app, auth_headers, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    # Both paths must write the job_logs table, or "after" measures the segment store instead
+    os.environ.setdefault("LOG_BACKEND", "database")
+    app, _, tmp = make_app()
+    from models import db, Job, JobLog
+
+    with app.app_context():
+        job = Job(name="bench-ingest", bundle_filename="bench.zip")
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+
+    batches = [[f"Epoch {b}: step {i} loss=0.{i:04d}" for i in range(args.batch_size)] for b in range(args.batches)]
+    total = args.batches * args.batch_size
+
+    with app.app_context(), Timer() as before:
+        for batch in batches:
+            for line in batch:
+                db.session.add(JobLog(job_id=job_id, message=line))
+                db.session.commit()
+
+    client = app.test_client()
+    headers = auth_headers(app)
+    with Timer() as after:
+        for batch in batches:
+            r = client.post(f"/api/jobs/{job_id}/logs", json={"lines": batch}, headers=headers)
+            assert r.status_code == 200, r.data
+
+    print(f"database: {tmp}")
+    print(f"{'path':<24}{'lines':>10}{'seconds':>10}{'lines/sec':>14}")
+    print(f"{'per-line commit':<24}{total:>10}{before.elapsed:>10.2f}{total / before.elapsed:>14.0f}")
+    print(f"{'bulk insert (HTTP)':<24}{total:>10}{after.elapsed:>10.2f}{total / after.elapsed:>14.0f}")
+    print(f"speedup: {before.elapsed / after.elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
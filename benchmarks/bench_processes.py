@@ -0,0 +1,94 @@
+"""Request throughput vs. number of server processes (gunicorn + eventlet).
+
+    python benchmarks/bench_processes.py --processes 1 2 4 --clients 16 --duration 15
+
+For each process count a fresh server is started through gunicorn.conf.py /
+wsgi.py, seeded with a few jobs and log lines, and hammered by ``--clients``
+load-generating processes running a read/write mix (job listing, log tails,
+log ingestion, heartbeats) for ``--duration`` seconds. Scaling needs free
+cores: on an N-core box expect gains up to roughly N processes.
+"""
+import argparse, io, time, zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+from _common import start_server, percentile
+
+TOKEN = "changeme-worker-token"
+HEADERS = {"Authorization": f"Bearer {TOKEN}"}
+
+
+def seed(base, jobs):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("main.py", "print('hello')\n")
+    ids = []
+    for i in range(jobs):
+        r = requests.post(f"{base}/api/jobs", data={"name": f"scale-{i}"},
+                          files={"file": ("bundle.zip", buf.getvalue())}, timeout=30)
+        r.raise_for_status()
+        job_id = r.json()["job_id"]
+        requests.post(f"{base}/api/jobs/{job_id}/logs", headers=HEADERS, timeout=30,
+                      json={"lines": [f"seed line {n}" for n in range(2000)]}).raise_for_status()
+        ids.append(job_id)
+    return ids
+
+
+def client(base, job_ids, duration, index):
+    """One load generator: loops over the request mix until the deadline."""
+    http = requests.Session()
+    http.headers.update(HEADERS)
+    mix = [
+        ("GET", "/api/jobs", None),
+        ("GET", f"/api/jobs/{job_ids[index % len(job_ids)]}/logs?tail=200", None),
+        ("POST", f"/api/jobs/{job_ids[index % len(job_ids)]}/logs",
+         {"lines": [f"client {index} step {n}" for n in range(50)]}),
+        ("POST", "/api/workers/heartbeat", {"name": f"scale-worker-{index}", "running_jobs": []}),
+    ]
+    latencies, errors, n = [], 0, 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        method, path, body = mix[n % len(mix)]
+        start = time.perf_counter()
+        r = http.request(method, base + path, json=body, timeout=60)
+        latencies.append(time.perf_counter() - start)
+        errors += r.status_code >= 400
+        n += 1
+    return latencies, errors
+
+
+def run(processes, args):
+    proc, base, _ = start_server("dtrain_scale_", args.database_url, workers=processes)
+    try:
+        job_ids = seed(base, args.jobs)
+        with ProcessPoolExecutor(args.clients) as pool:
+            results = list(pool.map(client, [base] * args.clients, [job_ids] * args.clients,
+                                    [args.duration] * args.clients, range(args.clients)))
+    finally:
+        proc.terminate()
+        proc.wait()
+    latencies = [t for lat, _ in results for t in lat]
+    errors = sum(e for _, e in results)
+    return len(latencies) / args.duration, percentile(latencies, 50), percentile(latencies, 99), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file per run")
+    args = parser.parse_args()
+
+    print(f"{'processes':>10}{'req/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'speedup':>9}")
+    baseline = None
+    for n in args.processes:
+        rps, p50, p99, errors = run(n, args)
+        baseline = baseline or rps
+        print(f"{n:>10}{rps:>12.0f}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}{errors:>8}{rps / baseline:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Seed a large database and time every read endpoint, with query plans.
+
+    python benchmarks/bench_queries.py --jobs 10000 --log-lines 10000000
+    python benchmarks/bench_queries.py --drop-indexes   # baseline without indexes
+
+Seeding uses chunked executemany straight through the engine; 10M log lines
+take a few minutes and roughly 1 GB of disk on SQLite.
+"""
+import argparse, os, random
+from datetime import datetime, timedelta
+
+from _common import make_app, auth_headers, Timer
+
+STATUSES = ["pending", "accepted", "running", "completed", "failed"]
+
+PLANS = {
+    # Same ORDER BY / LIMIT as scheduler.claim_next_job (PLACEMENT_WINDOW)
+    "pending jobs": "SELECT id FROM jobs WHERE status = 'pending' "
+                    "ORDER BY priority DESC, created_at ASC, id ASC LIMIT 50",
+    "job listing": "SELECT id FROM jobs ORDER BY created_at DESC LIMIT 50",
+    "log tail": "SELECT id FROM job_logs WHERE job_id = :job_id ORDER BY id DESC LIMIT 500",
+    "log page": "SELECT id FROM job_logs WHERE job_id = :job_id AND id > 0 ORDER BY id ASC LIMIT 1000",
+    "worker by name": "SELECT id FROM workers WHERE name = 'worker-7'",
+    "workers by last_seen": "SELECT id FROM workers ORDER BY last_seen DESC",
+}
+
+
+def seed(db, args):
+    from models import Worker, Job, JobLog
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    chunk = 50000
+    with db.engine.begin() as conn:
+        conn.execute(db.insert(Worker), [
+            {"name": f"worker-{i}", "token": "bench", "status": "idle", "last_seen": now - timedelta(seconds=i)}
+            for i in range(args.workers)
+        ])
+        conn.execute(db.insert(Job), [
+            {"name": f"job-{i}", "status": rng.choice(STATUSES), "bundle_filename": "bench.zip",
+             "created_at": now - timedelta(minutes=args.jobs - i), "updated_at": now}
+            for i in range(args.jobs)
+        ])
+    done = 0
+    while done < args.log_lines:
+        n = min(chunk, args.log_lines - done)
+        with db.engine.begin() as conn:
+            conn.execute(db.insert(JobLog), [
+                {"job_id": rng.randint(1, args.jobs), "ts": now, "level": "INFO",
+                 "message": f"Epoch {i % 100}: loss={rng.random():.4f}"}
+                for i in range(done, done + n)
+            ])
+        done += n
+        print(f"\rseeded {done}/{args.log_lines} log lines", end="", flush=True)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--log-lines", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--drop-indexes", action="store_true", help="measure without the secondary indexes")
+    args = parser.parse_args()
+
+    # This benchmark measures the relational schema, so keep log lines in the job_logs table
+    os.environ.setdefault("LOG_BACKEND", "database")
+    # and time the queries behind "/" and "/api/jobs", not the job-list response cache
+    os.environ.setdefault("JOB_LIST_CACHE_TTL_SEC", "0")
+    app, _, tmp = make_app()
+    from sqlalchemy import text
+    from models import db, JobLog
+
+    with app.app_context():
+        if args.drop_indexes:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(db.engine)
+        with Timer() as t:
+            seed(db, args)
+        print(f"seeded in {t.elapsed:.1f}s ({tmp})")
+        with db.engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+        busiest = db.session.query(JobLog.job_id, db.func.count()).group_by(JobLog.job_id) \
+            .order_by(db.func.count().desc()).first()[0]
+
+        if db.engine.dialect.name == "sqlite":
+            print("\nquery plans:")
+            with db.engine.connect() as conn:
+                for label, sql in PLANS.items():
+                    plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql), {"job_id": busiest}).fetchall()
+                    print(f"  {label:<22}" + " | ".join(row[-1] for row in plan))
+
+    client = app.test_client()
+    headers = auth_headers(app)
+    endpoints = [
+        "/",
+        "/api/jobs",
+        "/api/jobs/pending",
+        "/workers",
+        "/api/workers",
+        f"/jobs/{busiest}",
+        f"/api/jobs/{busiest}/log?tail=500",
+        f"/api/jobs/{busiest}/logs?tail=500",
+        f"/api/jobs/{busiest}/logs?after_id=0&limit=1000",
+    ]
+    print(f"\n{'endpoint':<48}{'min ms':>10}{'avg ms':>10}{'bytes':>12}")
+    for path in endpoints:
+        times, size = [], 0
+        for _ in range(args.repeat):
+            with Timer() as t:
+                r = client.get(path, headers=headers)
+            assert r.status_code == 200, (path, r.status_code)
+            times.append(t.elapsed * 1000)
+            size = len(r.data)
+        print(f"{path:<48}{min(times):>10.1f}{sum(times) / len(times):>10.1f}{size:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,28 @@
-import os, io, zipfile, time
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, abort
+import os, io, math, zipfile, time, json, logging
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, abort, Response, stream_with_context
 from flask_socketio import SocketIO, join_room, emit
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from models import db, Worker, Job, JobLog
+from models import db, Worker, Job, JobLog, Artifact
 import config
-from utils import save_upload
+from utils import save_upload, validate_bundle, BundleError, GzipRequestMiddleware
+from migrations import upgrade as upgrade_schema
+from storage import engine_options, tune_sqlite, startup_lock, GroupCommitter
+from logstore import create_log_store, migrate_db_logs
+from fanout import RoomDirectory, RedisRoomDirectory, RoomEmitter
+from cache import ResponseCache
+from metrics import MetricStore
+from instrumentation import instrument_app, instrument_engine, LOG_LINES_INGESTED, METRIC_POINTS_INGESTED, LOG_COMMIT_BATCH_ROWS
+import scheduler
+import uploads
+from artifacts import register_artifact, latest_artifact, serialize_artifact, backfill_artifacts
 from dotenv import load_dotenv
 import requests
 from google import genai
 
 load_dotenv()
+log = logging.getLogger("dtrain.server")
 ALLOWED_EXTENSIONS = {'.zip'}
 def allowed_file(filename):
     _, ext = os.path.splitext(filename)
@@ -130,26 +141,82 @@ def allowed_file(filename):
 #     return unsafe_files
 
 
+def configure_logging(level):
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+    logging.getLogger("dtrain").setLevel(level)
+
 def create_app():
     app = Flask(__name__)
     app.config.from_object(config)
+    configure_logging(app.config["SERVER_LOG_LEVEL"])
+    app.wsgi_app = GzipRequestMiddleware(app.wsgi_app, app.config["GZIP_REQUEST_MAX_BYTES"],
+                                         app.config["MAX_CONTENT_LENGTH"])
     CORS(app)
+    instrument_app(app)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
     db.init_app(app)
-    socketio = SocketIO(app, async_mode="eventlet", cors_allowed_origins="*")
+    socketio = SocketIO(app, async_mode="eventlet", cors_allowed_origins="*",
+                        message_queue=app.config["SOCKETIO_MESSAGE_QUEUE"])
+    job_notifier = scheduler.JobNotifier(socketio.server.eio.create_event)
+    if app.config["SOCKETIO_MESSAGE_QUEUE"]:
+        rooms = RedisRoomDirectory(socketio, app.config["SOCKETIO_MESSAGE_QUEUE"])
+    else:
+        rooms = RoomDirectory(socketio)
+    fanout = RoomEmitter(socketio, rooms, app.config["SOCKETIO_FLUSH_MS"] / 1000.0,
+                         app.config["SOCKETIO_ROOM_MAX_LINES"], app.config["SOCKETIO_CLIENT_MAX_QUEUE"])
+    app.extensions["fanout"] = fanout
+    socketio.start_background_task(fanout.run)
+    job_list_cache = ResponseCache(app.config["JOB_LIST_CACHE_TTL_SEC"])
+    app.extensions["job_list_cache"] = job_list_cache
+
+    def write_log_rows(rows):
+        # Single executemany + commit for everything in the group
+        db.session.execute(db.insert(JobLog), rows)
+        db.session.commit()
+        LOG_COMMIT_BATCH_ROWS.observe(len(rows))
+
+    log_committer = GroupCommitter(write_log_rows, socketio.server.eio.create_event, socketio.sleep,
+                                   app.config["LOG_GROUP_COMMIT_MS"] / 1000.0,
+                                   app.config["LOG_GROUP_COMMIT_MAX_ROWS"])
+    log_store = create_log_store(app.config, log_committer)
+    app.extensions["log_committer"] = log_committer
+    app.extensions["log_store"] = log_store
+    metric_store = MetricStore(app.config["METRICS_FOLDER"], app.config["METRICS_MAX_SERIES"],
+                               app.config["METRICS_DEFAULT_POINTS"], app.config["METRICS_MAX_POINTS"])
+    app.extensions["metric_store"] = metric_store
 
     with app.app_context():
-        db.create_all()
+        tune_sqlite(db.engine, app.config)
+        instrument_engine(db.engine)
+        # Several gunicorn workers boot at once; only one at a time may touch the schema
+        with startup_lock(app.config["SQLALCHEMY_DATABASE_URI"]):
+            db.create_all()
+            for change in upgrade_schema(db.engine):
+                log.info("Schema upgrade: %s", change)
+            backfill_artifacts(config.MODEL_UPLOADS_FOLDER)
+            moved = migrate_db_logs(log_store)
+            if moved:
+                log.info("Moved %d log lines from the database into %s", moved, app.config["LOG_STORE_FOLDER"])
+
+    @app.context_processor
+    def socketio_client_options():
+        # Without sticky sessions, long-polling would bounce between gunicorn workers
+        transports = ["websocket"] if app.config["WEB_WORKERS"] > 1 else ["polling", "websocket"]
+        return {"socketio_transports": transports}
 
     # -------- Web UI --------
     @app.route("/")
     def index():
-        jobs = Job.query.order_by(Job.created_at.desc()).all()
-        return render_template("index.html", jobs=jobs)
+        def render():
+            jobs, next_cursor = page_jobs_from_request()
+            return render_template("index.html", jobs=jobs, next_cursor=next_cursor, filters=request.args)
+        return cached_response(render)
 
     @app.route("/api/jobs/<int:job_id>/log")
     def job_detail_api(job_id):
         job = Job.query.get_or_404(job_id)
-        logs = JobLog.query.filter_by(job_id=job.id).order_by(JobLog.ts.asc()).all()
+        logs, has_more = page_logs_from_request(job.id)
         retData = {
             "job": {
                 "id": job.id,
@@ -161,44 +228,54 @@ def create_app():
                 "requirements_file": job.requirements_file,
                 "docker_image_tag": job.docker_image_tag,
             },
-            "logs": [
-                {
-                    "id": log.id,
-                    "job_id": log.job_id,
-                    "ts": log.ts.isoformat(),
-                    "level": log.level,
-                    "message": log.message,
-                } for log in logs
-            ]
+            "logs": [serialize_log(log) for log in logs],
+            "has_more": has_more,
         }
-        print(retData)
+        log.debug("Job %s: returning %d log lines", job.id, len(logs))
         return jsonify(retData)
 
 
     @app.route("/jobs/<int:job_id>")
     def job_detail(job_id):
         job = Job.query.get_or_404(job_id)
-        logs = JobLog.query.filter_by(job_id=job.id).order_by(JobLog.ts.asc()).all()
-        print(job)
-        print(logs)
-        print("god help us")
-        return render_template("job_detail.html", job=job, logs=logs)
+        logs, has_more = log_store.read(job.id, tail=app.config["LOG_TAIL_LINES"])
+        return render_template("job_detail.html", job=job, logs=logs, has_more=has_more,
+                               page_size=app.config["LOG_TAIL_LINES"])
 
     @app.route("/workers")
     def workers_page():
         workers = Worker.query.order_by(Worker.last_seen.desc()).all()
         return render_template("worker_dashboard.html", workers=workers)
 
+    @app.errorhandler(413)
+    def request_too_large(e):
+        # Raised by Werkzeug from the Content-Length alone, before the body is read
+        return jsonify({"error": f"request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
     # -------- API: Jobs --------
     @app.route("/api/jobs", methods=["GET"])
     def list_jobs():
-        jobs = Job.query.order_by(Job.created_at.desc()).all()
-        return jsonify([{
-            "id": j.id, "name": j.name, "status": j.status,
-            "created_at": j.created_at.isoformat(), "updated_at": j.updated_at.isoformat() if j.updated_at else None,
-            "bundle_filename": j.bundle_filename, "main_entry": j.main_entry, "requirements_file": j.requirements_file,
-            "accepted_by": j.accepted_by, "docker_image_tag": j.docker_image_tag
-        } for j in jobs])
+        # Newest first, keyset-paginated on (created_at, id):
+        #   ?limit=N&cursor=C        next page; C comes from the X-Next-Cursor header
+        #   ?status=a,b&worker=W     W is a worker name or id
+        #   ?created_after=D&created_before=D   ISO dates/datetimes
+        def render():
+            jobs, next_cursor = page_jobs_from_request()
+            resp = jsonify([{
+                "id": j.id, "name": j.name, "status": j.status,
+                "created_at": j.created_at.isoformat(), "updated_at": j.updated_at.isoformat() if j.updated_at else None,
+                "bundle_filename": j.bundle_filename, "bundle_sha256": j.bundle_sha256,
+                "main_entry": j.main_entry, "requirements_file": j.requirements_file,
+                "accepted_by": j.accepted_by, "docker_image_tag": j.docker_image_tag,
+                "priority": j.priority, "resources": job_resources(j),
+                "timeout_sec": j.timeout_sec, "build_timeout_sec": j.build_timeout_sec,
+                "cancel_requested": j.cancel_requested_at is not None
+            } for j in jobs])
+            resp.headers["X-Has-More"] = "true" if next_cursor else "false"
+            if next_cursor:
+                resp.headers["X-Next-Cursor"] = next_cursor
+            return resp
+        return cached_response(render)
 
     @app.route("/api/jobs", methods=["POST"])
     def create_job():
@@ -206,6 +283,11 @@ def create_app():
         name = request.form.get("name", "Untitled Job").strip()
         main_entry = request.form.get("main_entry", "main.py").strip()
         requirements_file = request.form.get("requirements_file", "requirements.txt").strip()
+        priority = request.form.get("priority", 0, type=int)
+        try:
+            resources = parse_job_limits(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         uploaded = request.files.get("file")
         # unsafe_files = validate_zip(uploaded)
         # if unsafe_files:
@@ -215,78 +297,227 @@ def create_app():
         if not allowed_file(uploaded.filename):
             return jsonify({"error": "Only .zip bundles are allowed"}), 400
 
-        bundle_filename, path = save_upload(uploaded)
-        job = Job(name=name, bundle_filename=bundle_filename, main_entry=main_entry, requirements_file=requirements_file)
+        try:
+            bundle_filename, path, bundle_sha256 = save_upload(
+                uploaded, max_bytes=config.BUNDLE_MAX_BYTES,
+                validate=lambda p: validate_bundle(p, config.BUNDLE_MAX_FILES, config.BUNDLE_MAX_UNCOMPRESSED_BYTES))
+        except BundleError as e:
+            return jsonify({"error": str(e)}), 400
+        job = Job(name=name, bundle_filename=bundle_filename, bundle_sha256=bundle_sha256, main_entry=main_entry,
+                  requirements_file=requirements_file, priority=priority, **resources)
         db.session.add(job)
         db.session.commit()
 
         # Pre-create a suggested docker tag per job
         job.docker_image_tag = f"mljob-{job.id}:latest"
         db.session.commit()
+        job_list_cache.invalidate()
+        job_notifier.notify()
 
         return jsonify({"message": "Job created", "job_id": job.id})
 
     @app.route("/api/jobs/<int:job_id>/download", methods=["GET"])
     def download_job(job_id):
         job = Job.query.get_or_404(job_id)
-        return send_from_directory(directory=config.JOB_BUNDLES_FOLDER, path=job.bundle_filename, as_attachment=True, download_name=f"job_{job.id}.zip")
+        # The content hash is a strong ETag, so If-None-Match gets a 304 for a bundle the client already has
+        extra = {"etag": job.bundle_sha256} if job.bundle_sha256 else {}
+        return send_from_directory(directory=config.JOB_BUNDLES_FOLDER, path=job.bundle_filename, as_attachment=True,
+                                   download_name=f"job_{job.id}.zip", **extra)
 
     # new route
 
     @app.route("/api/jobs/<int:job_id>/upload_model", methods=["POST"])
     def upload_model(job_id):
         job = Job.query.get_or_404(job_id)
-        print("jobUpload request received")
+        log.debug("Model upload received for job %s", job.id)
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
 
         if "file" not in request.files:
-            print("the files accessed from server is : " , request.files.getlist())
+            log.warning("Model upload for job %s has no 'file' part (got %s)", job.id, list(request.files))
             return jsonify({"error":"no file uploaded"}), 400
 
         f = request.files["file"]
         fname = secure_filename(f"job_{job.id}_" + f.filename)
         save_path = os.path.join(config.MODEL_UPLOADS_FOLDER, fname)
         f.save(save_path)
+        artifact = register_artifact(job.id, config.MODEL_UPLOADS_FOLDER, fname)
 
         append_log(job.id, f"Worker uploaded model file: {fname}")
-        return jsonify({"message":"model uploaded", "filename": fname})
+        return jsonify({"message":"model uploaded", "filename": fname, "artifact_id": artifact.id})
+
+    # -------- Chunked, resumable uploads (see uploads.py) --------
+    @app.route("/api/jobs/<int:job_id>/uploads", methods=["POST"])
+    def init_chunked_upload(job_id):
+        job = Job.query.get_or_404(job_id)
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        payload = request.get_json(force=True, silent=True) or {}
+        try:
+            upload_id = uploads.init_upload(config.MODEL_UPLOADS_FOLDER, job.id, payload.get("filename"),
+                                            payload.get("size"), payload.get("sha256"))
+        except uploads.UploadError as e:
+            return jsonify({"error": str(e)}), e.status
+        return jsonify({"upload_id": upload_id, "offset": 0, "chunk_size": app.config["UPLOAD_CHUNK_SIZE"]})
+
+    @app.route("/api/jobs/<int:job_id>/uploads/<upload_id>", methods=["GET", "PUT"])
+    def chunked_upload(job_id, upload_id):
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        try:
+            if request.method == "GET":
+                return jsonify({"offset": uploads.upload_offset(config.MODEL_UPLOADS_FOLDER, job_id, upload_id)})
+            offset = request.args.get("offset", type=int)
+            if offset is None:
+                return jsonify({"error": "offset required"}), 400
+            # request.stream is read incrementally; the chunk is never held in memory
+            new_offset = uploads.write_chunk(config.MODEL_UPLOADS_FOLDER, job_id, upload_id, offset, request.stream)
+            return jsonify({"offset": new_offset})
+        except uploads.UploadError as e:
+            return jsonify({"error": str(e), "offset": e.offset}), e.status
+
+    @app.route("/api/jobs/<int:job_id>/uploads/<upload_id>/complete", methods=["POST"])
+    def complete_chunked_upload(job_id, upload_id):
+        job = Job.query.get_or_404(job_id)
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        payload = request.get_json(force=True, silent=True) or {}
+        try:
+            fname, size, sha256 = uploads.complete_upload(config.MODEL_UPLOADS_FOLDER, job.id, upload_id,
+                                                          payload.get("sha256"))
+        except uploads.UploadError as e:
+            return jsonify({"error": str(e), "offset": e.offset}), e.status
+        artifact = register_artifact(job.id, config.MODEL_UPLOADS_FOLDER, fname, sha256=sha256)
+        append_log(job.id, f"Worker uploaded model file: {fname}")
+        return jsonify({"message":"model uploaded", "filename": fname, "size": size, "sha256": sha256,
+                        "artifact_id": artifact.id})
 
     @app.route("/api/jobs/<int:job_id>/download_model", methods=["GET"])
     def download_model(job_id):
         job = Job.query.get_or_404(job_id)
-        # find latest uploaded file for this job
-        for fname in os.listdir(config.MODEL_UPLOADS_FOLDER):
-            if fname.startswith(f"job_{job.id}_"):
-                return send_from_directory(
-                    directory=config.MODEL_UPLOADS_FOLDER,
-                    path=fname,
-                    as_attachment=True,
-                    download_name=f"job_{job.id}_model.pkl"
-                )
-        return jsonify({"error":"no model found"}), 404
+        # latest uploaded file for this job
+        artifact = latest_artifact(job.id)
+        if artifact is None:
+            return jsonify({"error":"no model found"}), 404
+        return send_artifact(artifact)
+
+    @app.route("/api/jobs/<int:job_id>/artifacts", methods=["GET"])
+    def list_artifacts(job_id):
+        job = Job.query.get_or_404(job_id)
+        artifacts = Artifact.query.filter_by(job_id=job.id).order_by(Artifact.created_at.desc(), Artifact.id.desc()).all()
+        return jsonify([serialize_artifact(a) for a in artifacts])
+
+    @app.route("/api/jobs/<int:job_id>/artifacts/<int:artifact_id>", methods=["GET"])
+    def download_artifact(job_id, artifact_id):
+        artifact = Artifact.query.filter_by(id=artifact_id, job_id=job_id).first_or_404()
+        return send_artifact(artifact)
+
+    def send_artifact(artifact):
+        # conditional=True gives Range/206 and If-None-Match support; the file body is
+        # handed to the WSGI server's file_wrapper (sendfile) or to the proxy when
+        # USE_X_SENDFILE is on, so it never passes through Python.
+        extra = {"etag": artifact.sha256} if artifact.sha256 else {}
+        return send_from_directory(
+            directory=config.MODEL_UPLOADS_FOLDER,
+            path=artifact.filename,
+            as_attachment=True,
+            download_name=artifact.filename,
+            mimetype=artifact.content_type,
+            conditional=True,
+            **extra
+        )
 
     @app.route("/api/jobs/<int:job_id>/accept", methods=["POST"])
     def accept_job(job_id):
         job = Job.query.get_or_404(job_id)
-        if job.status != "pending":
-            return jsonify({"error": "Job already accepted or not pending"}), 409
-        worker_name = request.json.get("worker_name")
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
-        worker = Worker.query.filter_by(name=worker_name).first()
-        if not worker:
-            worker = Worker(name=worker_name, token=token, status="idle")
-            db.session.add(worker)
-            db.session.commit()
-        job.accepted_by = worker.id
-        job.status = "accepted"
-        db.session.commit()
+        worker = get_or_create_worker(request.json.get("worker_name"), token)
+        # Conditional UPDATE: only one of several racing workers can win
+        if not scheduler.claim_job(job.id, worker.id, app.config["JOB_LEASE_SEC"]):
+            return jsonify({"error": "Job already accepted or not pending"}), 409
+        job_list_cache.invalidate()
         append_log(job.id, f"Worker '{worker.name}' accepted job.")
-        socketio.emit("job_status", {"job_id": job.id, "status": job.status}, to=f"job_{job.id}")
-        return jsonify({"message":"accepted", "docker_image_tag": job.docker_image_tag})
+        fanout.emit("job_status", job.id, {"job_id": job.id, "status": "accepted"})
+        return jsonify({"message":"accepted", "docker_image_tag": job.docker_image_tag,
+                        "lease_sec": app.config["JOB_LEASE_SEC"]})
+
+    @app.route("/api/jobs/claim", methods=["POST"])
+    def claim_job():
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        payload = request.get_json(force=True, silent=True) or {}
+        worker = get_or_create_worker(payload.get("worker_name"), token)
+        update_worker_capacity(worker, payload)
+        worker_id, worker_name = worker.id, worker.name
+        free = scheduler.free_capacity(worker)
+        # Long-poll: with {"wait": N} an idle worker is held for up to N seconds
+        # and woken as soon as create_job (or a requeue) makes a job available.
+        try:
+            wait = min(max(float(payload.get("wait") or 0), 0), app.config["CLAIM_MAX_WAIT_SEC"])
+        except (TypeError, ValueError):
+            wait = 0
+        deadline = time.monotonic() + wait
+        while True:
+            wakeup = job_notifier.event
+            job = scheduler.claim_next_job(worker_id, app.config["JOB_LEASE_SEC"], free)
+            remaining = deadline - time.monotonic()
+            if job is not None or remaining <= 0:
+                break
+            db.session.close()  # don't pin a pooled connection while parked
+            wakeup.wait(min(remaining, app.config["CLAIM_RECHECK_SEC"]))
+        if job is None:
+            return "", 204
+        job_list_cache.invalidate()
+        append_log(job.id, f"Worker '{worker_name}' claimed job (attempt {job.attempts}).")
+        fanout.emit("job_status", job.id, {"job_id": job.id, "status": job.status})
+        return jsonify({**worker_job_payload(job), "lease_sec": app.config["JOB_LEASE_SEC"]})
+
+    @app.route("/api/jobs/<int:job_id>/renew", methods=["POST"])
+    def renew_job_lease(job_id):
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        worker = get_or_create_worker((request.get_json(force=True, silent=True) or {}).get("worker_name"), token)
+        if not scheduler.renew_lease(job_id, worker.id, app.config["JOB_LEASE_SEC"]):
+            return jsonify({"error": "lease lost"}), 409
+        return jsonify({"message": "renewed", "lease_sec": app.config["JOB_LEASE_SEC"]})
+
+    @app.route("/api/jobs/<int:job_id>/release", methods=["POST"])
+    def release_job(job_id):
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        worker = get_or_create_worker((request.get_json(force=True, silent=True) or {}).get("worker_name"), token)
+        if not scheduler.release_job(job_id, worker.id):
+            return jsonify({"error": "job not held by this worker"}), 409
+        job_list_cache.invalidate()
+        job_notifier.notify()
+        append_log(job_id, f"Worker '{worker.name}' released job back to the queue.")
+        fanout.emit("job_status", job_id, {"job_id": job_id, "status": "pending"})
+        return jsonify({"message": "released"})
+
+    @app.route("/api/jobs/<int:job_id>/cancel", methods=["POST"])
+    def cancel_job(job_id):
+        # Pending jobs are canceled at once; running ones once their worker has stopped them
+        status, changed = scheduler.cancel_job(job_id)
+        if status is None:
+            abort(404)
+        if status in ("completed", "failed"):
+            return jsonify({"error": f"job already {status}", "status": status}), 409
+        if changed:
+            job_list_cache.invalidate()
+            append_log(job_id, "[SCHEDULER] Job canceled." if status == "canceled" else
+                       "[SCHEDULER] Cancellation requested, waiting for the worker to stop the job.")
+            fanout.emit("job_status", job_id, {"job_id": job_id, "status": status,
+                                               "cancel_requested": status != "canceled"})
+        return jsonify({"message": "canceled" if status == "canceled" else "cancel requested", "status": status})
 
     @app.route("/api/jobs/<int:job_id>/status", methods=["POST"])
     def update_job_status(job_id):
@@ -294,13 +525,21 @@ def create_app():
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
-        status = request.json.get("status", "running")
-        note = request.json.get("note")
-        job.status = status
-        db.session.commit()
+        payload = request.get_json(force=True, silent=True) or {}
+        status = payload.get("status", "running")
+        note = payload.get("note")
+        if job.status == "canceled":
+            return jsonify({"error": "job was canceled"}), 409
+        # Only the worker holding the lease may move the job; a report that
+        # arrives after its lease expired must not resurrect a requeued job
+        worker = Worker.query.filter_by(name=payload.get("worker_name") or "worker").first()
+        status = scheduler.report_status(job.id, worker.id, status, app.config["JOB_LEASE_SEC"]) if worker else None
+        if status is None:
+            return jsonify({"error": "job not held by this worker"}), 409
+        job_list_cache.invalidate()
         if note:
             append_log(job.id, f"[STATUS] {note}")
-        socketio.emit("job_status", {"job_id": job.id, "status": status}, to=f"job_{job.id}")
+        fanout.emit("job_status", job.id, {"job_id": job.id, "status": status})
         return jsonify({"message":"ok"})
 
     @app.route("/api/jobs/<int:job_id>/logs", methods=["POST"])
@@ -310,13 +549,38 @@ def create_app():
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
         payload = request.get_json(force=True, silent=True) or {}
-        lines = payload.get("lines", [])
-        for line in lines:
-            append_log(job.id, line)
-        # Fan-out to web clients
-        for line in lines:
-            socketio.emit("job_log", {"job_id": job.id, "line": line}, to=f"job_{job.id}")
-        return jsonify({"message": "ok", "count": len(lines)})
+        lines = [str(line) for line in payload.get("lines", [])]
+        if lines:
+            append_logs(job.id, lines)
+            LOG_LINES_INGESTED.inc(len(lines))
+            # Coalesced per room; nothing is serialized if no browser is watching
+            fanout.push_lines(job.id, lines)
+        # Log uploads double as a fast cancellation channel for busy jobs
+        return jsonify({"message": "ok", "count": len(lines), "cancel": job.cancel_requested_at is not None})
+
+    @app.route("/api/jobs/<int:job_id>/metrics", methods=["POST"])
+    def ingest_metrics(job_id):
+        job = Job.query.get_or_404(job_id)
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        payload = request.get_json(force=True, silent=True) or {}
+        points = payload.get("points")
+        if not isinstance(points, list):
+            return jsonify({"error": "points must be a list"}), 400
+        kept = metric_store.append(job.id, points, time.time())
+        METRIC_POINTS_INGESTED.inc(len(kept))
+        if kept:
+            fanout.emit("job_metrics", job.id, {"job_id": job.id, "points": kept})
+        return jsonify({"message": "ok", "count": len(kept)})
+
+    @app.route("/api/jobs/<int:job_id>/metrics", methods=["GET"])
+    def get_job_metrics(job_id):
+        # ?names=loss,acc  ?max_points=N (LTTB-downsampled past N points per series)
+        job = Job.query.get_or_404(job_id)
+        names = [n for n in request.args.get("names", "").split(",") if n]
+        series, downsampled = metric_store.read(job.id, names or None, request.args.get("max_points", type=int))
+        return jsonify({"job_id": job.id, "series": series, "downsampled": downsampled})
 
     # -------- API: Workers --------
     @app.route("/api/workers/register", methods=["POST"])
@@ -324,15 +588,27 @@ def create_app():
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
-        name = request.json.get("name", "worker")
-        worker = Worker.query.filter_by(name=name).first()
-        if not worker:
-            worker = Worker(name=name, token=token, status="idle")
-            db.session.add(worker)
-        worker.last_seen = datetime.utcnow()
-        db.session.commit()
+        worker = get_or_create_worker(request.json.get("name", "worker"), token)
+        update_worker_capacity(worker, request.json)
         return jsonify({"message":"registered", "worker_id": worker.id})
 
+    @app.route("/api/workers/heartbeat", methods=["POST"])
+    def worker_heartbeat():
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token != app.config["WORKER_SHARED_TOKEN"]:
+            return jsonify({"error":"unauthorized"}), 401
+        payload = request.get_json(force=True, silent=True) or {}
+        worker = get_or_create_worker(payload.get("name"), token)
+        held = [j for j in payload.get("running_jobs", []) if isinstance(j, int)]
+        worker.running_jobs = len(held)
+        worker.status = "busy" if held else "idle"
+        update_worker_capacity(worker, payload)
+        # One round trip renews the lease of every job the worker holds
+        still_ours = scheduler.renew_leases(worker.id, held, app.config["JOB_LEASE_SEC"])
+        return jsonify({"lease_sec": app.config["JOB_LEASE_SEC"],
+                        "lost_jobs": [j for j in held if j not in still_ours],
+                        "cancel": [j for j, requested in still_ours.items() if requested]})
+
     @app.route("/api/workers", methods=["GET"])
     def list_workers():
         workers = Worker.query.order_by(Worker.last_seen.desc()).all()
@@ -341,25 +617,38 @@ def create_app():
                 "id": w.id,
                 "name": w.name,
                 "status": w.status,
-                "last_seen": w.last_seen.isoformat() if w.last_seen else None
+                "last_seen": w.last_seen.isoformat() if w.last_seen else None,
+                "slots_total": w.slots_total,
+                "slots_free": w.slots_free,
+                "running_jobs": w.running_jobs,
+                "cpu_count": w.cpu_count,
+                "cpu_percent": w.cpu_percent,
+                "mem_total_mb": w.mem_total_mb,
+                "mem_available_mb": w.mem_available_mb,
+                "disk_free_mb": w.disk_free_mb,
             }
             for w in workers
         ])
 
     @app.route("/api/jobs/<int:job_id>/logs", methods=["GET"])
     def get_job_logs(job_id):
+        # Keyset pagination on the per-job line id:
+        #   ?after_id=X&limit=N   next N lines after X (oldest first)
+        #   ?before_id=X&limit=N  N lines just before X (for scrolling back)
+        #   ?tail=N               last N lines
+        #   ?format=ndjson        stream every matching line as NDJSON
         job = Job.query.get_or_404(job_id)
-        logs = JobLog.query.filter_by(job_id=job.id).order_by(JobLog.ts.asc()).all()
-        return jsonify([
-            {
-                "id": log.id,
-                "job_id": log.job_id,
-                "message": log.message,
-                "level": log.level,
-                "ts": log.ts.isoformat()
-            }
-            for log in logs
-        ])
+        wants_ndjson = request.args.get("format") == "ndjson" or \
+            request.accept_mimetypes.best == "application/x-ndjson"
+        if wants_ndjson:
+            return stream_logs_ndjson(job.id)
+        logs, has_more = page_logs_from_request(job.id)
+        resp = jsonify([serialize_log(log) for log in logs])
+        if logs:
+            resp.headers["X-First-Log-Id"] = str(logs[0].id)
+            resp.headers["X-Last-Log-Id"] = str(logs[-1].id)
+        resp.headers["X-Has-More"] = "true" if has_more else "false"
+        return resp
 
 
     @app.route("/api/jobs/pending", methods=["GET"])
@@ -367,8 +656,9 @@ def create_app():
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         if token != app.config["WORKER_SHARED_TOKEN"]:
             return jsonify({"error":"unauthorized"}), 401
-        jobs = Job.query.filter(Job.status == "pending").order_by(Job.created_at.asc()).all()
-        return jsonify([{"id": j.id, "name": j.name, "bundle_filename": j.bundle_filename, "main_entry": j.main_entry, "requirements_file": j.requirements_file, "docker_image_tag": j.docker_image_tag} for j in jobs])
+        jobs = Job.query.filter(Job.status == "pending") \
+            .order_by(Job.priority.desc(), Job.created_at.asc(), Job.id.asc()).all()
+        return jsonify([worker_job_payload(j) for j in jobs])
 
     # -------- Socket.IO --------
     @socketio.on("join_job")
@@ -377,11 +667,202 @@ def create_app():
         join_room(f"job_{job_id}")
         emit("joined", {"room": f"job_{job_id}"})
 
-    def append_log(job_id, message, level="INFO"):
-        entry = JobLog(job_id=job_id, message=message, level=level)
-        db.session.add(entry)
+    def get_or_create_worker(name, token):
+        name = name or "worker"
+        worker = Worker.query.filter_by(name=name).first()
+        if not worker:
+            worker = Worker(name=name, token=token, status="idle")
+            db.session.add(worker)
+            db.session.commit()
+        return worker
+
+    def update_worker_capacity(worker, payload):
+        # Agents advertise slot counts on register/claim and full load on every heartbeat
+        worker.last_seen = datetime.utcnow()
+        if worker.status == "offline":
+            worker.status = "idle"
+        for field in ("slots_total", "slots_free", "cpu_count", "cpu_percent",
+                      "mem_total_mb", "mem_available_mb", "disk_free_mb"):
+            value = payload.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                setattr(worker, field, value)
         db.session.commit()
 
+    def worker_job_payload(j):
+        return {"id": j.id, "name": j.name, "bundle_filename": j.bundle_filename, "bundle_sha256": j.bundle_sha256,
+                "main_entry": j.main_entry,
+                "requirements_file": j.requirements_file, "docker_image_tag": j.docker_image_tag,
+                "priority": j.priority, "resources": job_resources(j),
+                "timeout_sec": j.timeout_sec, "build_timeout_sec": j.build_timeout_sec}
+
+    def job_resources(j):
+        return {"cpus": j.req_cpus, "memory_mb": j.req_memory_mb, "disk_mb": j.req_disk_mb,
+                "est_duration_sec": j.est_duration_sec}
+
+    def parse_job_limits(form):
+        # Optional form fields -> Job columns; blank means "no requirement" / worker default
+        fields = {"cpus": ("req_cpus", float), "memory_mb": ("req_memory_mb", int),
+                  "disk_mb": ("req_disk_mb", int), "est_duration_sec": ("est_duration_sec", int),
+                  "timeout_sec": ("timeout_sec", int), "build_timeout_sec": ("build_timeout_sec", int)}
+        out = {}
+        for field, (column, cast) in fields.items():
+            raw = (form.get(field) or "").strip()
+            if not raw:
+                continue
+            try:
+                value = cast(raw)
+            except ValueError:
+                raise ValueError(f"{field} must be a number")
+            if not math.isfinite(value):
+                # inf would fit no worker and leave the job pending forever
+                raise ValueError(f"{field} must be a finite number")
+            if value <= 0:
+                raise ValueError(f"{field} must be positive")
+            out[column] = value
+        return out
+
+    # -------- Liveness / lease reaper --------
+    def lease_reaper():
+        while True:
+            socketio.sleep(app.config["JOB_LEASE_CHECK_SEC"])
+            try:
+                with app.app_context():
+                    for name in scheduler.mark_offline_workers(app.config["WORKER_TIMEOUT_SEC"]):
+                        log.warning("Worker '%s' missed its heartbeat, marked offline", name)
+                    changed = scheduler.requeue_expired(app.config["JOB_MAX_ATTEMPTS"])
+                    if changed:
+                        job_list_cache.invalidate()
+                    for job_id, status in changed:
+                        note = {"pending": "requeued", "canceled": "canceled"}.get(status, "failed after too many attempts")
+                        append_log(job_id, f"[SCHEDULER] Lease expired, job {note}.")
+                        fanout.emit("job_status", job_id, {"job_id": job_id, "status": status})
+                    if any(status == "pending" for _, status in changed):
+                        job_notifier.notify()
+            except Exception:
+                log.exception("Lease reaper error")
+
+    socketio.start_background_task(lease_reaper)
+
+    def upload_sweeper():
+        while True:
+            socketio.sleep(app.config["UPLOAD_SWEEP_SEC"])
+            try:
+                for upload_id in uploads.sweep_stale(config.MODEL_UPLOADS_FOLDER, app.config["UPLOAD_STALE_SEC"]):
+                    log.info("Deleted abandoned upload %s", upload_id)
+            except Exception:
+                log.exception("Upload sweeper error")
+
+    socketio.start_background_task(upload_sweeper)
+
+    def append_log(job_id, message, level="INFO"):
+        append_logs(job_id, [message], level)
+
+    def append_logs(job_id, messages, level="INFO"):
+        log_store.append(job_id, messages, level)
+
+    # -------- Job listing --------
+    def parse_timestamp(name):
+        raw = request.args.get(name)
+        if not raw:
+            return None
+        try:
+            return datetime.fromisoformat(raw)
+        except ValueError:
+            abort(400, description=f"{name} must be an ISO date or datetime")
+
+    def query_jobs(statuses=None, worker=None, created_after=None, created_before=None, cursor=None, limit=None):
+        """Return (jobs newest-first, next_cursor or None) for one keyset page."""
+        limit = max(1, min(limit or app.config["JOB_PAGE_DEFAULT_LIMIT"], app.config["JOB_PAGE_MAX_LIMIT"]))
+        q = Job.query
+        if statuses:
+            q = q.filter(Job.status.in_(statuses))
+        if worker:
+            if worker.isdigit():
+                q = q.filter(Job.accepted_by == int(worker))
+            else:
+                q = q.filter(Job.accepted_by.in_(db.session.query(Worker.id).filter(Worker.name == worker)))
+        if created_after is not None:
+            q = q.filter(Job.created_at >= created_after)
+        if created_before is not None:
+            q = q.filter(Job.created_at < created_before)
+        if cursor is not None:
+            ts, last_id = cursor
+            q = q.filter(db.or_(Job.created_at < ts, db.and_(Job.created_at == ts, Job.id < last_id)))
+        rows = q.order_by(Job.created_at.desc(), Job.id.desc()).limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        last = rows[limit - 1]
+        return rows[:limit], f"{last.created_at.isoformat()}_{last.id}"
+
+    def page_jobs_from_request():
+        cursor = None
+        raw_cursor = request.args.get("cursor")
+        if raw_cursor:
+            try:
+                ts, _, last_id = raw_cursor.rpartition("_")
+                cursor = (datetime.fromisoformat(ts), int(last_id))
+            except ValueError:
+                abort(400, description="invalid cursor")
+        statuses = [s for s in request.args.get("status", "").split(",") if s]
+        return query_jobs(statuses, request.args.get("worker", "").strip() or None,
+                          parse_timestamp("created_after"), parse_timestamp("created_before"),
+                          cursor, request.args.get("limit", type=int))
+
+    def cached_response(render):
+        # Serve repeated dashboard/API fetches from the short-TTL cache, with ETag/304
+        key = request.full_path
+        entry = job_list_cache.get(key)
+        if entry is None:
+            resp = render()
+            if not isinstance(resp, Response):
+                resp = app.make_response(resp)
+            extra = {k: v for k, v in resp.headers.items() if k.startswith("X-")}
+            entry = job_list_cache.put(key, resp.get_data(), resp.mimetype, extra)
+        resp = Response(entry.body, mimetype=entry.mimetype, headers=entry.headers)
+        resp.set_etag(entry.etag)
+        resp.headers["Cache-Control"] = "no-cache"  # always revalidate; the ETag makes that cheap
+        return resp.make_conditional(request)
+
+    # -------- Log retrieval --------
+    def serialize_log(log):
+        return {
+            "id": log.id,
+            "job_id": log.job_id,
+            "ts": log.ts.isoformat(),
+            "level": log.level,
+            "message": log.message,
+        }
+
+    def page_logs_from_request(job_id):
+        return log_store.read(
+            job_id,
+            after_id=request.args.get("after_id", type=int),
+            before_id=request.args.get("before_id", type=int),
+            limit=request.args.get("limit", type=int),
+            tail=request.args.get("tail", type=int),
+        )
+
+    def stream_logs_ndjson(job_id):
+        after_id = request.args.get("after_id", type=int) or 0
+        remaining = request.args.get("limit", type=int)
+        chunk = app.config["LOG_PAGE_DEFAULT_LIMIT"]
+
+        def generate():
+            cursor, left = after_id, remaining
+            while left is None or left > 0:
+                size = chunk if left is None else min(chunk, left)
+                rows, _ = log_store.read(job_id, after_id=cursor, limit=size)
+                if not rows:
+                    break
+                yield "".join(json.dumps(serialize_log(r)) + "\n" for r in rows)
+                cursor = rows[-1].id
+                if left is not None:
+                    left -= len(rows)
+                # Don't hold a session/transaction open between chunks
+                db.session.remove()
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
     @app.template_filter("fmt_ts")
     def fmt_ts(ts):
         return ts.strftime("%Y-%m-%d %H:%M:%S")
@@ -389,6 +870,6 @@ def create_app():
     return app, socketio
 
 if __name__ == "__main__":
+    # Development server (single process). In production run gunicorn: see wsgi.py
     app, socketio = create_app()
-    # eventlet is required for Flask-SocketIO default async
-    socketio.run(app ,host="10.50.48.56",port=5000, debug=True)
+    socketio.run(app, host=config.BIND_HOST, port=config.PORT, debug=config.DEBUG)
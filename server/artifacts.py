@@ -0,0 +1,70 @@
+"""Artifact registry: one ``Artifact`` row per file a job uploaded.
+
+Lookups go through the indexed table instead of scanning MODEL_UPLOADS_FOLDER,
+and "the" model of a job is deterministically its most recent artifact.
+"""
+import os, re, hashlib, mimetypes
+from datetime import datetime
+
+from models import db, Artifact
+
+_LEGACY_NAME = re.compile(r"^job_(\d+)_")
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def register_artifact(job_id, folder, filename, sha256=None):
+    """Insert or refresh the row for ``folder/filename`` (re-uploads replace the file)."""
+    path = os.path.join(folder, filename)
+    artifact = Artifact.query.filter_by(job_id=job_id, filename=filename).first()
+    if artifact is None:
+        artifact = Artifact(job_id=job_id, filename=filename)
+        db.session.add(artifact)
+    artifact.size = os.path.getsize(path)
+    artifact.sha256 = sha256 or file_sha256(path)
+    artifact.content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    artifact.created_at = datetime.utcnow()
+    db.session.commit()
+    return artifact
+
+
+def latest_artifact(job_id):
+    return (Artifact.query.filter_by(job_id=job_id)
+            .order_by(Artifact.created_at.desc(), Artifact.id.desc()).first())
+
+
+def serialize_artifact(a):
+    return {
+        "id": a.id,
+        "job_id": a.job_id,
+        "filename": a.filename,
+        "size": a.size,
+        "sha256": a.sha256,
+        "content_type": a.content_type,
+        "created_at": a.created_at.isoformat(),
+        "download_url": f"/api/jobs/{a.job_id}/artifacts/{a.id}",
+    }
+
+
+def backfill_artifacts(folder):
+    """Register ``job_<id>_*`` files uploaded before the registry existed. Runs only on an empty table."""
+    if not os.path.isdir(folder) or db.session.query(Artifact.id).first() is not None:
+        return 0
+    from models import Job
+
+    count = 0
+    for fname in sorted(os.listdir(folder)):
+        m = _LEGACY_NAME.match(fname)
+        if not m or not os.path.isfile(os.path.join(folder, fname)):
+            continue
+        if db.session.get(Job, int(m.group(1))) is None:
+            continue
+        register_artifact(int(m.group(1)), folder, fname)
+        count += 1
+    return count
@@ -0,0 +1,43 @@
+"""Short-lived in-process cache for rendered responses.
+
+The dashboard and ``GET /api/jobs`` are fetched over and over while nothing
+changes. Responses are kept for ``ttl_sec`` keyed by path + query string and
+dropped wholesale by ``invalidate()``, which the app calls on every job state
+change. Other server processes don't see the invalidation, so their copies
+live at most ``ttl_sec`` longer. Every entry carries a strong ETag (SHA-1 of
+the body) for ``If-None-Match``.
+"""
+import hashlib, time
+from collections import OrderedDict, namedtuple
+
+CachedResponse = namedtuple("CachedResponse", "body mimetype headers etag expires")
+
+
+class ResponseCache:
+    def __init__(self, ttl_sec, max_entries=256):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, body, mimetype, headers=None):
+        entry = CachedResponse(body, mimetype, dict(headers or {}), hashlib.sha1(body).hexdigest(),
+                               time.monotonic() + self.ttl_sec)
+        if self.ttl_sec > 0:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        self._entries.clear()
@@ -0,0 +1,160 @@
+"""Room-aware, coalescing Socket.IO fan-out for job events.
+
+Emitting once per ingested batch straight to ``job_<id>`` serializes and sends
+even when no browser is watching, and floods watchers of a busy job. Instead:
+
+* lines for a room nobody has joined are dropped before any serialization;
+* lines for watched rooms are buffered and sent as one ``job_logs`` frame per
+  room every ``SOCKETIO_FLUSH_MS`` (keeping at most ``SOCKETIO_ROOM_MAX_LINES``
+  per frame, oldest dropped first);
+* a client whose outbound queue is past ``SOCKETIO_CLIENT_MAX_QUEUE`` packets is
+  skipped until it drains, then told how many lines it missed (``dropped``) so
+  the page can refetch them over HTTP.
+
+With ``SOCKETIO_MESSAGE_QUEUE`` set (e.g. ``redis://localhost:6379/0``) every
+server process publishes the rooms it has listeners for, so a process that
+ingests logs knows whether anyone on *another* process is watching.
+"""
+import logging, uuid
+
+from instrumentation import SOCKETIO_EMITS
+
+log = logging.getLogger("dtrain.fanout")
+
+
+def job_room(job_id):
+    return f"job_{job_id}"
+
+
+class RoomDirectory:
+    """Which rooms have listeners, as seen by this process."""
+
+    def __init__(self, socketio, namespace="/"):
+        self.socketio = socketio
+        self.namespace = namespace
+
+    def _rooms(self):
+        return self.socketio.server.manager.rooms.get(self.namespace, {})
+
+    def local_rooms(self):
+        return {room for room, members in self._rooms().items()
+                if isinstance(room, str) and room.startswith("job_") and members}
+
+    def has_listeners(self, room):
+        return bool(self._rooms().get(room))
+
+    def sync(self):
+        pass
+
+
+class RedisRoomDirectory(RoomDirectory):
+    """Shares room occupancy between server processes through Redis.
+
+    Each process keeps its occupied rooms in its own short-lived set, rewritten
+    on every ``sync``; the union of the other processes' sets is cached until the
+    next one. A key expires when its process dies, so stale rooms age out.
+    """
+
+    KEY_PREFIX = "dtrain:rooms:"
+
+    def __init__(self, socketio, url, ttl_sec=5, namespace="/"):
+        super().__init__(socketio, namespace)
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._key = self.KEY_PREFIX + uuid.uuid4().hex
+        self._ttl = ttl_sec
+        self._remote = set()
+
+    def has_listeners(self, room):
+        return super().has_listeners(room) or room in self._remote
+
+    def sync(self):
+        mine = self.local_rooms()
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key)
+        if mine:
+            pipe.sadd(self._key, *mine)
+            pipe.expire(self._key, self._ttl)
+        pipe.execute()
+        others = [k for k in self._redis.scan_iter(self.KEY_PREFIX + "*") if k.decode() != self._key]
+        self._remote = {r.decode() for r in self._redis.sunion(others)} if others else set()
+
+
+class RoomEmitter:
+    """Buffers job events per room and flushes them from a background task."""
+
+    def __init__(self, socketio, directory, interval_sec=0.1, max_lines=2000, client_max_queue=100):
+        self.socketio = socketio
+        self.directory = directory
+        self.interval_sec = interval_sec
+        self.max_lines = max_lines
+        self.client_max_queue = client_max_queue
+        self._pending = {}   # room -> {"job_id", "lines", "dropped"}
+        self._lagging = {}   # (room, sid) -> lines a slow client has missed
+        self.stats = {"frames": 0, "lines_sent": 0, "lines_skipped": 0, "lines_dropped": 0}
+
+    def push_lines(self, job_id, lines):
+        room = job_room(job_id)
+        if not lines:
+            return
+        if not self.directory.has_listeners(room):
+            self.stats["lines_skipped"] += len(lines)
+            return
+        buf = self._pending.setdefault(room, {"job_id": job_id, "lines": [], "dropped": 0})
+        buf["lines"].extend(lines)
+        overflow = len(buf["lines"]) - self.max_lines
+        if overflow > 0:
+            del buf["lines"][:overflow]
+            buf["dropped"] += overflow
+            self.stats["lines_dropped"] += overflow
+
+    def emit(self, event, job_id, payload):
+        """Send a (rare) event right away, after any lines still buffered for the room."""
+        room = job_room(job_id)
+        if not self.directory.has_listeners(room):
+            return
+        buf = self._pending.pop(room, None)
+        if buf:
+            self._send_lines(room, buf)
+        self.socketio.emit(event, payload, to=room)
+        SOCKETIO_EMITS.labels(event).inc()
+
+    def flush(self):
+        self.directory.sync()
+        pending, self._pending = self._pending, {}
+        for room, buf in pending.items():
+            self._send_lines(room, buf)
+
+    def _send_lines(self, room, buf):
+        eio = self.socketio.server.eio
+        present, slow = set(), []
+        for sid, eio_sid in self.socketio.server.manager.get_participants(self.directory.namespace, room):
+            present.add(sid)
+            sock = eio.sockets.get(eio_sid)
+            if sock is not None and sock.queue.qsize() > self.client_max_queue:
+                slow.append(sid)
+        missed = len(buf["lines"]) + buf["dropped"]
+        for sid in slow:
+            self._lagging[(room, sid)] = self._lagging.get((room, sid), 0) + missed
+        for key in [k for k in self._lagging if k[0] == room]:
+            sid = key[1]
+            if sid not in present:
+                del self._lagging[key]
+            elif sid not in slow:
+                # Caught up: tell it about the gap before it gets new lines
+                self.socketio.emit("job_logs", {"job_id": buf["job_id"], "lines": [],
+                                                "dropped": self._lagging.pop(key)}, to=sid)
+                SOCKETIO_EMITS.labels("job_logs").inc()
+        self.socketio.emit("job_logs", {"job_id": buf["job_id"], "lines": buf["lines"], "dropped": buf["dropped"]},
+                           to=room, skip_sid=slow or None)
+        SOCKETIO_EMITS.labels("job_logs").inc()
+        self.stats["frames"] += 1
+        self.stats["lines_sent"] += len(buf["lines"])
+
+    def run(self):
+        while True:
+            self.socketio.sleep(self.interval_sec)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Socket.IO fan-out error")
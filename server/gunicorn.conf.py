@@ -0,0 +1,41 @@
+"""gunicorn settings for the production server, taken from config.py / its env vars.
+
+    WEB_WORKERS=4 SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 gunicorn -c gunicorn.conf.py wsgi:app
+
+Add PROMETHEUS_MULTIPROC_DIR=/some/dir so /metrics sums over all workers.
+"""
+import os, glob
+
+# Not "config": gunicorn would read that name as its own -c setting
+import config as dtrain
+
+bind = f"{dtrain.BIND_HOST}:{dtrain.PORT}"
+workers = dtrain.WEB_WORKERS
+worker_class = "eventlet"
+worker_connections = 1000
+# Claims long-poll for up to CLAIM_MAX_WAIT_SEC; give in-flight requests that long on restart
+graceful_timeout = dtrain.CLAIM_MAX_WAIT_SEC + 5
+loglevel = dtrain.SERVER_LOG_LEVEL.lower()
+accesslog = "-" if dtrain.ACCESS_LOG else None
+errorlog = "-"
+
+
+def on_starting(server):
+    folder = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if folder:
+        # Samples left over from a previous run would be added to the new totals
+        os.makedirs(folder, exist_ok=True)
+        for path in glob.glob(os.path.join(folder, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    if dtrain.WEB_WORKERS > 1 and not dtrain.SOCKETIO_MESSAGE_QUEUE:
+        server.log.warning("WEB_WORKERS > 1 without SOCKETIO_MESSAGE_QUEUE: browsers only get "
+                           "live events from jobs handled by the process they are connected to")
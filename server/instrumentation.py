@@ -0,0 +1,81 @@
+"""Prometheus metrics for the server, exposed on ``GET /metrics``.
+
+* ``dtrain_http_request_duration_seconds{method,route,status}`` - per Flask
+  route (the URL rule, so ids don't explode the label set)
+* ``dtrain_db_query_duration_seconds{statement}`` - every SQL statement, by verb
+* ``dtrain_log_lines_ingested_total`` / ``dtrain_metric_points_ingested_total``
+* ``dtrain_socketio_emits_total{event}`` - frames actually handed to Socket.IO
+* ``dtrain_log_commit_batch_rows`` - rows per group commit (database log backend)
+
+With several gunicorn workers set ``PROMETHEUS_MULTIPROC_DIR`` to an empty,
+writable directory; every process then writes its samples there and any of
+them can answer a scrape with the sum (see gunicorn.conf.py).
+"""
+import os, time
+
+from flask import request, g, Response
+from sqlalchemy import event
+from prometheus_client import (Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+REQUEST_SECONDS = Histogram(
+    "dtrain_http_request_duration_seconds", "Time spent handling HTTP requests",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+DB_QUERY_SECONDS = Histogram(
+    "dtrain_db_query_duration_seconds", "Time spent executing SQL statements", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+LOG_LINES_INGESTED = Counter("dtrain_log_lines_ingested_total", "Log lines received from workers")
+METRIC_POINTS_INGESTED = Counter("dtrain_metric_points_ingested_total", "Training metric points received from workers")
+SOCKETIO_EMITS = Counter("dtrain_socketio_emits_total", "Socket.IO events emitted to rooms or clients", ["event"])
+LOG_COMMIT_BATCH_ROWS = Histogram(
+    "dtrain_log_commit_batch_rows", "Log rows written per group commit",
+    buckets=(1, 5, 10, 50, 100, 500, 1000, 5000))
+
+_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "PRAGMA", "CREATE", "ALTER", "BEGIN", "COMMIT"}
+
+
+def instrument_app(app):
+    """Time every request and serve ``/metrics``."""
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(
+                time.perf_counter() - started)
+        return response
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        registry = REGISTRY
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def instrument_engine(engine):
+    """Time every statement run on ``engine``."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        DB_QUERY_SECONDS.labels(verb if verb in _STATEMENTS else "OTHER").observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        # after_cursor_execute never fires for a failed statement
+        stack = context.connection.info.get("query_started") if context.connection is not None else None
+        if stack:
+            stack.pop()
@@ -0,0 +1,437 @@
+"""Job log storage backends.
+
+Logs are the bulk of the data, so by default they live outside the relational
+database in per-job, append-only segment files (``LOG_BACKEND = "segments"``);
+``"database"`` keeps the old one-``JobLog``-row-per-line table.
+
+Layout of ``LOG_STORE_FOLDER/job_<id>/``::
+
+    000000000001.log      NDJSON lines {"ts", "level", "message"}, appended to
+    000000000001.idx      one little-endian uint64 byte offset per line
+    000000050001.log.gz   a sealed segment: blocks of LOG_BLOCK_LINES lines, each
+    000000050001.bidx     compressed on its own; count + block offsets
+
+Line ids are per job and dense (1, 2, 3, ...), with the file name holding the
+id of a segment's first line, so any id maps to a segment and an index slot
+without scanning: tails and keyset pages are a couple of range reads. A
+segment is sealed (compressed) once it reaches LOG_SEGMENT_BYTES. A sealed
+gzip segment is a valid multi-member gzip file, so ``zcat`` works on it.
+"""
+import os, io, json, gzip, struct, threading
+from abc import ABC, abstractmethod
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+from models import db, JobLog
+from storage import DirLocks
+
+LogRecord = namedtuple("LogRecord", "id job_id ts level message")
+
+_U64 = struct.Struct("<Q")
+
+
+def _clamp_limit(limit, default_limit, max_limit):
+    return max(1, min(limit or default_limit, max_limit))
+
+
+class LogStore(ABC):
+    """Interface shared by the backends."""
+
+    def __init__(self, default_limit=1000, max_limit=10000):
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+
+    @abstractmethod
+    def append(self, job_id, messages, level="INFO", ts=None):
+        """Append ``messages`` to the job's log, in order."""
+
+    @abstractmethod
+    def read(self, job_id, after_id=None, before_id=None, limit=None, tail=None):
+        """Return (records oldest-first, has_more) for one keyset page.
+
+        ``after_id``/``limit`` pages forward, ``before_id``/``limit`` pages
+        backwards from a cursor and ``tail`` returns the last N lines.
+        """
+
+    @abstractmethod
+    def count(self, job_id):
+        """Number of lines stored for the job."""
+
+
+class DatabaseLogStore(LogStore):
+    """One ``JobLog`` row per line; appends go through a ``GroupCommitter``."""
+
+    def __init__(self, committer, **kw):
+        super().__init__(**kw)
+        self.committer = committer
+
+    def append(self, job_id, messages, level="INFO", ts=None):
+        ts = ts or datetime.utcnow()
+        self.committer.append([{"job_id": job_id, "ts": ts, "level": level, "message": m} for m in messages])
+
+    def read(self, job_id, after_id=None, before_id=None, limit=None, tail=None):
+        q = JobLog.query.filter(JobLog.job_id == job_id)
+        if tail is not None:
+            limit, before_id = tail, None
+        limit = _clamp_limit(limit, self.default_limit, self.max_limit)
+        if after_id is not None:
+            q = q.filter(JobLog.id > after_id)
+        if before_id is not None or tail is not None:
+            # Walk backwards from the cursor, then flip to chronological order
+            if before_id is not None:
+                q = q.filter(JobLog.id < before_id)
+            rows = q.order_by(JobLog.id.desc()).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            return [self._record(r) for r in reversed(rows[:limit])], has_more
+        rows = q.order_by(JobLog.id.asc()).limit(limit + 1).all()
+        return [self._record(r) for r in rows[:limit]], len(rows) > limit
+
+    def count(self, job_id):
+        return JobLog.query.filter(JobLog.job_id == job_id).count()
+
+    @staticmethod
+    def _record(row):
+        return LogRecord(row.id, row.job_id, row.ts, row.level, row.message)
+
+
+class GzipCodec:
+    suffix = ".gz"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec:
+    suffix = ".zst"
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise RuntimeError("LOG_COMPRESSION=zstd requires the zstandard package")
+        self._c = zstandard.ZstdCompressor(level=level)
+        self._d = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def decompress(self, data):
+        return self._d.decompress(data)
+
+
+CODECS = {"none": None, "gzip": GzipCodec, "zstd": ZstdCodec}
+
+# A segment as found on disk: the id of its first line, how many lines it holds,
+# and either the raw .log/.idx pair or the sealed, compressed file + block index.
+_Segment = namedtuple("_Segment", "first count log idx sealed bidx")
+
+# Jobs whose segment listing is kept in memory (least recently used are dropped)
+SEGMENT_CACHE_JOBS = 4096
+
+
+class SegmentLogStore(LogStore):
+    """Append-only segment files with an offset index; see the module docstring."""
+
+    def __init__(self, root, segment_bytes=16 * 1024 * 1024, compression="gzip", block_lines=256, **kw):
+        super().__init__(**kw)
+        if compression not in CODECS:
+            raise ValueError(f"LOG_COMPRESSION must be one of {sorted(CODECS)}")
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.block_lines = block_lines
+        self.compression = compression
+        self.codec = CODECS[compression]() if CODECS[compression] else None
+        self._locks = DirLocks()
+        self._segment_cache = OrderedDict()  # job_id -> (directory mtime, [_Segment])
+        self._cache_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    # -------- layout --------
+    def job_dir(self, job_id):
+        return os.path.join(self.root, f"job_{int(job_id)}")
+
+    def _segments(self, job_id):
+        """The job's segments, oldest first.
+
+        The listing is cached per job and only rescanned when the directory
+        changes, i.e. when a segment is rolled or sealed (by any process).
+        Between those, appends only grow the last segment, whose count is
+        read off its index size: one ``stat`` of each instead of a listing.
+        """
+        folder = self.job_dir(job_id)
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._cache_lock:
+            cached = self._segment_cache.get(job_id)
+            if cached is not None:
+                self._segment_cache.move_to_end(job_id)
+        if cached is None or cached[0] != mtime:
+            cached = self._remember(job_id, mtime, self._scan(folder))
+        segments = cached[1]
+        last = segments[-1] if segments else None
+        if last is not None and not last.sealed:
+            try:
+                count = os.path.getsize(last.idx) // _U64.size
+            except FileNotFoundError:  # sealed elsewhere within one mtime tick
+                return self._remember(job_id, mtime, self._scan(folder))[1]
+            if count != last.count:
+                with self._cache_lock:
+                    if segments[-1] is last:
+                        segments[-1] = last._replace(count=count)
+        return segments
+
+    def _remember(self, job_id, mtime, segments):
+        with self._cache_lock:
+            entry = self._segment_cache[job_id] = (mtime, segments)
+            self._segment_cache.move_to_end(job_id)
+            while len(self._segment_cache) > SEGMENT_CACHE_JOBS:
+                self._segment_cache.popitem(last=False)
+        return entry
+
+    def _scan(self, folder):
+        names = set(os.listdir(folder))
+        segments = []
+        for name in sorted(n for n in names if n.endswith(".idx") or n.endswith(".bidx")):
+            stem, ext = os.path.splitext(name)
+            first = int(stem)
+            if ext == ".bidx":
+                sealed = next((stem + ".log" + c.suffix for c in (GzipCodec, ZstdCodec)
+                               if stem + ".log" + c.suffix in names), None)
+                if sealed is None:
+                    continue
+                with open(os.path.join(folder, name), "rb") as f:
+                    count = _U64.unpack(f.read(_U64.size))[0]
+                segments.append(_Segment(first, count, None, None, os.path.join(folder, sealed),
+                                         os.path.join(folder, name)))
+            elif stem + ".bidx" not in names:  # leftover of an interrupted seal otherwise
+                idx = os.path.join(folder, name)
+                segments.append(_Segment(first, os.path.getsize(idx) // _U64.size,
+                                         os.path.join(folder, stem + ".log"), idx, None, None))
+        return segments
+
+    def count(self, job_id):
+        segments = self._segments(job_id)
+        return segments[-1].first + segments[-1].count - 1 if segments else 0
+
+    # -------- writing --------
+    def append(self, job_id, messages, level="INFO", ts=None):
+        ts = ts or datetime.utcnow()
+        self.append_entries(job_id, [(ts, level, m) for m in messages])
+
+    def append_entries(self, job_id, entries):
+        """Append ``(ts, level, message)`` tuples in order."""
+        if not entries:
+            return
+        with self._locks.hold(self.job_dir(job_id)) as folder:
+            segments = self._segments(job_id)
+            last = segments[-1] if segments else None
+            sealed = None
+            if last is None:
+                first = 1
+            elif last.sealed or os.path.getsize(last.log) >= self.segment_bytes:
+                if not last.sealed:
+                    sealed = self._seal(last)
+                first = last.first + last.count
+            else:
+                first = last.first
+            log_path = os.path.join(folder, f"{first:012d}.log")
+            idx_path = os.path.join(folder, f"{first:012d}.idx")
+            if os.path.exists(idx_path) and os.path.getsize(idx_path) % _U64.size:
+                # Torn index entry from a crash mid-append: drop it (the line is unindexed)
+                with open(idx_path, "r+b") as f:
+                    f.truncate(os.path.getsize(idx_path) // _U64.size * _U64.size)
+            buf, offsets = io.BytesIO(), []
+            with open(log_path, "ab") as log:
+                base = log.tell()
+                for ts, level, message in entries:
+                    offsets.append(base + buf.tell())
+                    buf.write(json.dumps({"ts": ts.isoformat(), "level": level, "message": message},
+                                         ensure_ascii=False).encode() + b"\n")
+                log.write(buf.getvalue())
+            # Index after data: readers trust only indexed lines, which are always complete
+            with open(idx_path, "ab") as idx:
+                idx.write(b"".join(_U64.pack(o) for o in offsets))
+            # Keep the cached listing in step with the roll/seal instead of rescanning
+            with self._cache_lock:
+                if sealed is not None:
+                    segments[-1] = sealed
+                if last is not None and first == last.first:
+                    segments[-1] = last._replace(count=last.count + len(offsets))
+                else:
+                    segments.append(_Segment(first, len(offsets), log_path, idx_path, None, None))
+            self._remember(job_id, os.stat(folder).st_mtime_ns, segments)
+
+    def _seal(self, seg):
+        """Compress a full .log segment into independently decompressible blocks. Returns the sealed segment."""
+        if self.codec is None:
+            return seg
+        stem = seg.log[:-len(".log")]
+        with open(seg.idx, "rb") as f:
+            offsets = [o for (o,) in _U64.iter_unpack(f.read(seg.count * _U64.size))]
+        with open(seg.log, "rb") as f:
+            lines = _indexed_lines(f.read(), offsets, 0)
+        sealed, bidx = stem + ".log" + self.codec.suffix, stem + ".bidx"
+        block_offsets = []
+        with open(sealed + ".tmp", "wb") as out:
+            for i in range(0, len(lines), self.block_lines):
+                block_offsets.append(out.tell())
+                out.write(self.codec.compress(b"".join(lines[i:i + self.block_lines])))
+            block_offsets.append(out.tell())
+        with open(bidx + ".tmp", "wb") as out:
+            out.write(_U64.pack(len(offsets)) + b"".join(_U64.pack(o) for o in block_offsets))
+        os.replace(sealed + ".tmp", sealed)
+        os.replace(bidx + ".tmp", bidx)
+        os.remove(seg.idx)
+        os.remove(seg.log)
+        return _Segment(seg.first, seg.count, None, None, sealed, bidx)
+
+    # -------- reading --------
+    def read(self, job_id, after_id=None, before_id=None, limit=None, tail=None):
+        if tail is not None:
+            limit, before_id = tail, None
+        limit = _clamp_limit(limit, self.default_limit, self.max_limit)
+        for attempt in range(2):
+            try:
+                return self._read(job_id, after_id, before_id, limit, tail)
+            except FileNotFoundError:
+                if attempt:  # a segment got sealed under us; the retry sees the new layout
+                    raise
+
+    def _read(self, job_id, after_id, before_id, limit, tail):
+        segments = self._segments(job_id)
+        total = segments[-1].first + segments[-1].count - 1 if segments else 0
+        floor = (after_id or 0) + 1
+        if before_id is not None or tail is not None:
+            hi = total if before_id is None else min(total, before_id - 1)
+            lo = max(floor, hi - limit + 1)
+            has_more = lo > floor
+        else:
+            lo = floor
+            hi = min(total, lo + limit - 1)
+            has_more = hi < total
+        if hi < lo:
+            return [], False
+        records = []
+        for seg in segments:
+            start, stop = max(lo, seg.first), min(hi, seg.first + seg.count - 1)
+            if start > stop:
+                continue
+            lines = self._read_sealed(seg, start, stop) if seg.sealed else self._read_log(seg, start, stop)
+            for n, line in enumerate(lines, start):
+                entry = json.loads(line)
+                records.append(LogRecord(n, job_id, datetime.fromisoformat(entry["ts"]),
+                                         entry["level"], entry["message"]))
+        return records, has_more
+
+    def _read_log(self, seg, start, stop):
+        i, want = start - seg.first, stop - start + 1
+        with open(seg.idx, "rb") as f:
+            f.seek(i * _U64.size)
+            # One extra offset (when there is one) marks where the last wanted line ends
+            offsets = [o for (o,) in _U64.iter_unpack(f.read(_U64.size * (want + 1)))]
+        with open(seg.log, "rb") as f:
+            f.seek(offsets[0])
+            data = f.read(offsets[-1] - offsets[0])
+            if len(offsets) == want:
+                data += f.readline()
+        return _indexed_lines(data, offsets[:want], offsets[0])
+
+    def _read_sealed(self, seg, start, stop):
+        i, j = start - seg.first, stop - seg.first
+        b0, b1 = i // self.block_lines, j // self.block_lines
+        with open(seg.bidx, "rb") as f:
+            f.seek(_U64.size * (1 + b0))
+            bounds = [o for (o,) in _U64.iter_unpack(f.read(_U64.size * (b1 - b0 + 2)))]
+        with open(seg.sealed, "rb") as f:
+            f.seek(bounds[0])
+            raw = f.read(bounds[-1] - bounds[0])
+        codec = ZstdCodec() if seg.sealed.endswith(ZstdCodec.suffix) else GzipCodec()
+        lines = []
+        for k in range(len(bounds) - 1):
+            block = raw[bounds[k] - bounds[0]:bounds[k + 1] - bounds[0]]
+            lines.extend(codec.decompress(block).splitlines())
+        skip = i - b0 * self.block_lines
+        return lines[skip:skip + (j - i + 1)]
+
+
+def _indexed_lines(data, offsets, base):
+    """Slice the lines starting at ``offsets`` out of ``data`` (which starts at file offset ``base``).
+
+    Going by the index rather than splitting on newlines skips any unindexed
+    bytes a crash left between two appends.
+    """
+    lines = []
+    for off in offsets:
+        start = off - base
+        lines.append(data[start:data.index(b"\n", start) + 1])
+    return lines
+
+
+def create_log_store(config, committer):
+    """Build the backend selected by ``LOG_BACKEND``."""
+    limits = {"default_limit": config["LOG_PAGE_DEFAULT_LIMIT"], "max_limit": config["LOG_PAGE_MAX_LIMIT"]}
+    backend = config["LOG_BACKEND"]
+    if backend == "database":
+        return DatabaseLogStore(committer, **limits)
+    if backend == "segments":
+        return SegmentLogStore(config["LOG_STORE_FOLDER"], config["LOG_SEGMENT_BYTES"],
+                               config["LOG_COMPRESSION"], config["LOG_BLOCK_LINES"], **limits)
+    raise ValueError(f"unknown LOG_BACKEND {backend!r}")
+
+
+def migrate_db_logs(store, chunk=50000):
+    """Move ``JobLog`` rows into a segment store, job by job. Returns lines moved.
+
+    Each job is written to a temp directory that is renamed into place before
+    its rows are deleted, so an interrupted run is simply repeated. A job that
+    already has segments (e.g. after switching LOG_BACKEND back and forth)
+    gets only its rows newer than its last stored line appended; older ones
+    are the copies a run interrupted after the rename left behind.
+    """
+    if not isinstance(store, SegmentLogStore):
+        return 0
+    moved = 0
+    job_ids = [j for (j,) in db.session.query(JobLog.job_id).distinct()]
+    for job_id in job_ids:
+        final = store.job_dir(job_id)
+        if os.path.isdir(final):
+            tail, _ = store.read(job_id, tail=1)
+            rows = JobLog.query.filter(JobLog.job_id == job_id)
+            if tail:
+                rows = rows.filter(JobLog.ts > tail[0].ts)
+            moved += _copy_rows(rows, store, job_id, chunk)
+        else:
+            tmp_store = SegmentLogStore(os.path.join(store.root, ".migrating"), store.segment_bytes,
+                                        store.compression, store.block_lines)
+            tmp_dir = tmp_store.job_dir(job_id)
+            if os.path.isdir(tmp_dir):
+                for name in os.listdir(tmp_dir):
+                    os.remove(os.path.join(tmp_dir, name))
+            moved += _copy_rows(JobLog.query.filter(JobLog.job_id == job_id), tmp_store, job_id, chunk)
+            os.replace(tmp_dir, final)
+        JobLog.query.filter(JobLog.job_id == job_id).delete(synchronize_session=False)
+        db.session.commit()
+    return moved
+
+
+def _copy_rows(query, store, job_id, chunk):
+    """Append the rows of ``query`` to ``store`` in id order, ``chunk`` at a time."""
+    copied = cursor = 0
+    while True:
+        rows = query.filter(JobLog.id > cursor).order_by(JobLog.id.asc()).limit(chunk).all()
+        if not rows:
+            return copied
+        store.append_entries(job_id, [(r.ts or datetime.utcnow(), r.level or "INFO", r.message) for r in rows])
+        cursor = rows[-1].id
+        copied += len(rows)
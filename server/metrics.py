@@ -0,0 +1,137 @@
+"""Per-job training metrics stored as compact time series.
+
+Workers parse metric points out of container output and POST them to
+``/api/jobs/<id>/metrics``. Every series (one metric name of one job) is an
+append-only file of float64 triples ``(step, ts, value)``::
+
+    METRICS_FOLDER/job_<id>/loss.f64
+
+That is 24 bytes per point with no per-row overhead. A read loads the file
+into an ``array('d')`` and splits it into step/ts/value columns with strided
+slices. A point without a step stores NaN there. Series longer than the
+requested number of points are downsampled with largest-triangle-three-buckets
+(LTTB), which keeps spikes and the overall shape of a curve.
+"""
+import os, re, math
+from array import array
+
+from storage import DirLocks
+
+METRIC_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.\-]{0,63}$")
+SUFFIX = ".f64"
+
+
+class MetricStore:
+    def __init__(self, root, max_series=100, default_points=1000, max_points=10000):
+        self.root = root
+        self.max_series = max_series
+        self.default_points = default_points
+        self.max_points = max_points
+        self._locks = DirLocks()
+        os.makedirs(root, exist_ok=True)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, f"job_{int(job_id)}")
+
+    def names(self, job_id):
+        try:
+            return sorted(n[:-len(SUFFIX)] for n in os.listdir(self.job_dir(job_id)) if n.endswith(SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def append(self, job_id, points, now):
+        """Store ``{"step", "ts", "values": {name: number}}`` points. Returns the points kept.
+
+        Invalid names and non-finite values are skipped, as are new names once a
+        job has ``max_series`` series. ``now`` stands in for a missing ``ts``.
+        """
+        columns, kept = {}, []
+        for point in points:
+            if not isinstance(point, dict) or not isinstance(point.get("values"), dict):
+                continue
+            step, ts = _number(point.get("step")), _number(point.get("ts"))
+            ts = now if ts is None else ts
+            values = {name: v for name, v in ((n, _number(v)) for n, v in point["values"].items())
+                      if v is not None and isinstance(name, str) and METRIC_NAME.match(name)}
+            if not values:
+                continue
+            for name, value in values.items():
+                columns.setdefault(name, array("d")).extend((math.nan if step is None else step, ts, value))
+            kept.append({"step": step, "ts": ts, "values": values})
+        if not columns:
+            return []
+        with self._locks.hold(self.job_dir(job_id)) as folder:
+            existing = set(self.names(job_id))
+            room = self.max_series - len(existing)
+            for name in sorted(columns):
+                if name not in existing:
+                    if room <= 0:
+                        for point in kept:
+                            point["values"].pop(name, None)
+                        continue
+                    room -= 1
+                with open(os.path.join(folder, name + SUFFIX), "ab") as f:
+                    f.write(columns[name].tobytes())
+        return [p for p in kept if p["values"]]
+
+    def read(self, job_id, names=None, max_points=None):
+        """Return ``({name: {"step", "ts", "value", "count"}}, downsampled)``.
+
+        Each series is reduced to at most ``max_points`` points (clamped to
+        ``max_points`` of the store); ``count`` is the full length.
+        """
+        max_points = max(3, min(max_points or self.default_points, self.max_points))
+        wanted = self.names(job_id)
+        if names:
+            names = set(names)
+            wanted = [n for n in wanted if n in names]
+        series, downsampled = {}, False
+        for name in wanted:
+            data = array("d")
+            with open(os.path.join(self.job_dir(job_id), name + SUFFIX), "rb") as f:
+                raw = f.read()
+            data.frombytes(raw[:len(raw) - len(raw) % (3 * data.itemsize)])  # ignore a torn trailing point
+            steps, ts, values = data[0::3], data[1::3], data[2::3]
+            count = len(values)
+            if count > max_points:
+                xs = ts if any(math.isnan(s) for s in steps) else steps
+                keep = lttb(xs, values, max_points)
+                steps, ts, values = ([col[i] for i in keep] for col in (steps, ts, values))
+                downsampled = True
+            series[name] = {"step": [None if math.isnan(s) else int(s) if s.is_integer() else s for s in steps],
+                            "ts": list(ts),
+                            "value": list(values), "count": count}
+        return series, downsampled
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value) if math.isfinite(value) else None
+
+
+def lttb(xs, ys, threshold):
+    """Indices of ``threshold`` points that best keep the shape of ``(xs, ys)``."""
+    n = len(ys)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    picked, a = [0], 0
+    for i in range(threshold - 2):
+        lo, hi = int(i * every) + 1, int((i + 1) * every) + 1
+        # The next bucket is represented by its average point (the last point for the last bucket)
+        nlo, nhi = hi, min(int((i + 2) * every) + 1, n)
+        if nlo >= nhi:
+            nlo, nhi = n - 1, n
+        avg_x = sum(xs[nlo:nhi]) / (nhi - nlo)
+        avg_y = sum(ys[nlo:nhi]) / (nhi - nlo)
+        ax, ay = xs[a], ys[a]
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
@@ -0,0 +1,73 @@
+"""Lightweight, additive schema migrations for existing databases.
+
+``db.create_all()`` only creates missing tables, so an ``app.db`` from an older
+release never gets new columns or indexes. ``upgrade`` compares the models with
+the live schema and adds whatever is missing: columns via ``ALTER TABLE ...
+ADD COLUMN`` (backfilled from scalar defaults) and indexes via ``CREATE INDEX``.
+Columns and tables are never dropped or rewritten; the only thing removed is
+an index listed in ``SUPERSEDED_INDEXES`` once its replacement exists.
+
+Run it by hand with ``python migrations.py`` from the server directory; the app
+also calls it on startup.
+"""
+from sqlalchemy import inspect, text
+
+from models import db
+
+# Old index name -> the index that replaces it (same table)
+SUPERSEDED_INDEXES = {
+    "ix_jobs_status_priority_created_at": "ix_jobs_status_priority_desc_created_at_id",
+}
+
+
+def _add_column(conn, table, column):
+    col_type = column.type.compile(dialect=conn.dialect)
+    ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    conn.execute(text(ddl))
+    default = column.default
+    if default is not None and default.is_scalar:
+        conn.execute(text(f"UPDATE {table.name} SET {column.name} = :v WHERE {column.name} IS NULL"),
+                     {"v": default.arg})
+
+
+def upgrade(engine):
+    """Bring ``engine``'s schema up to date with the models. Returns the changes made."""
+    changes = []
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                table.create(conn)
+                changes.append(f"create table {table.name}")
+                continue
+            existing_cols = {c["name"] for c in insp.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_cols:
+                    _add_column(conn, table, column)
+                    changes.append(f"add column {table.name}.{column.name}")
+            existing_ix = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_ix:
+                    index.create(conn)
+                    changes.append(f"create index {index.name}")
+            for old, new in SUPERSEDED_INDEXES.items():
+                if old in existing_ix and new in {ix.name for ix in table.indexes}:
+                    conn.execute(text(f"DROP INDEX {old}"))
+                    changes.append(f"drop index {old}")
+        if changes and engine.dialect.name == "sqlite":
+            # Refresh planner statistics so the new indexes are actually used
+            conn.execute(text("ANALYZE"))
+    return changes
+
+
+if __name__ == "__main__":
+    from flask import Flask
+    import config
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    db.init_app(app)
+    with app.app_context():
+        print("\n".join(upgrade(db.engine)) or "schema up to date")
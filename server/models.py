@@ -10,6 +10,21 @@ class Worker(db.Model):
     token = db.Column(db.String(120), nullable=False)  # demo auth
     status = db.Column(db.String(32), default="idle")  # idle, busy, offline
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    slots_total = db.Column(db.Integer, default=1)  # max_concurrent_jobs advertised by the agent
+    slots_free = db.Column(db.Integer, default=1)
+    # Load reported by the latest heartbeat
+    running_jobs = db.Column(db.Integer, default=0)
+    cpu_count = db.Column(db.Integer, nullable=True)
+    cpu_percent = db.Column(db.Float, nullable=True)
+    mem_total_mb = db.Column(db.Integer, nullable=True)
+    mem_available_mb = db.Column(db.Integer, nullable=True)
+    disk_free_mb = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_workers_name", "name"),
+        db.Index("ix_workers_last_seen", "last_seen"),
+        db.Index("ix_workers_status_last_seen", "status", "last_seen"),  # liveness reaper
+    )
 
 class Job(db.Model):
     __tablename__ = "jobs"
@@ -19,11 +34,33 @@ class Job(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     bundle_filename = db.Column(db.String(300), nullable=False)  # zip path relative to JOB_BUNDLES_FOLDER
+    bundle_sha256 = db.Column(db.String(64), nullable=True)       # content hash; bundles are stored as <sha256>.zip
     main_entry = db.Column(db.String(200), default="main.py")     # which file to run in the container
     requirements_file = db.Column(db.String(200), default="requirements.txt")
     accepted_by = db.Column(db.Integer, db.ForeignKey("workers.id"), nullable=True)
     docker_image_tag = db.Column(db.String(200), nullable=True)   # image tag that workers should build/use
     notes = db.Column(db.Text, nullable=True)
+    priority = db.Column(db.Integer, default=0)                   # higher runs first, FIFO within a priority
+    attempts = db.Column(db.Integer, default=0)                   # how many times the job has been leased
+    lease_expires_at = db.Column(db.DateTime, nullable=True)      # requeued if the worker stops renewing
+    # Declared resource requests; NULL means "no requirement"
+    req_cpus = db.Column(db.Float, nullable=True)
+    req_memory_mb = db.Column(db.Integer, nullable=True)
+    req_disk_mb = db.Column(db.Integer, nullable=True)
+    est_duration_sec = db.Column(db.Integer, nullable=True)
+    # Limits enforced by the worker; NULL falls back to the worker's configured defaults
+    timeout_sec = db.Column(db.Integer, nullable=True)            # wall-clock limit for the container run
+    build_timeout_sec = db.Column(db.Integer, nullable=True)      # limit for building the job's image
+    cancel_requested_at = db.Column(db.DateTime, nullable=True)   # set on a leased job until its worker stops it
+
+    __table_args__ = (
+        db.Index("ix_jobs_status_created_at", "status", "created_at"),  # pending queue
+        # Claim order: matches ORDER BY priority DESC, created_at, id so claims read it without a sort
+        db.Index("ix_jobs_status_priority_desc_created_at_id", "status", priority.desc(), "created_at", "id"),
+        db.Index("ix_jobs_status_lease_expires_at", "status", "lease_expires_at"),           # lease reaper
+        db.Index("ix_jobs_created_at", "created_at"),                   # dashboard listing
+        db.Index("ix_jobs_accepted_by", "accepted_by"),
+    )
 
 class JobLog(db.Model):
     __tablename__ = "job_logs"
@@ -32,3 +69,23 @@ class JobLog(db.Model):
     ts = db.Column(db.DateTime, default=datetime.utcnow)
     level = db.Column(db.String(16), default="INFO")
     message = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        # Log pages are keyset-paginated on id within a job
+        db.Index("ix_job_logs_job_id_id", "job_id", "id"),
+        db.Index("ix_job_logs_job_id_ts", "job_id", "ts"),
+    )
+
+class Artifact(db.Model):
+    __tablename__ = "artifacts"
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey("jobs.id"), nullable=False)
+    filename = db.Column(db.String(300), nullable=False)         # file name in MODEL_UPLOADS_FOLDER
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    sha256 = db.Column(db.String(64), nullable=True)
+    content_type = db.Column(db.String(120), default="application/octet-stream")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_artifacts_job_id_filename", "job_id", "filename", unique=True),
+    )
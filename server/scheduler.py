@@ -0,0 +1,297 @@
+"""Job queue: atomic claiming, lease renewal and requeue of expired leases.
+
+Every state transition is a single conditional ``UPDATE ... WHERE status = ...``
+(compare-and-set), so two workers racing for the same job can never both win,
+on SQLite or PostgreSQL alike. Claim order is ``priority DESC`` and then FIFO
+(``created_at``, ``id``) within a priority.
+
+Placement is resource-aware: a worker is only offered jobs whose declared
+cpus/memory/disk fit what it has left, and among the fitting jobs at the top
+priority in the first ``PLACEMENT_WINDOW`` of the queue it gets the *tightest*
+fit (best-fit bin packing). Big workers therefore take the big jobs, and small
+workers never receive jobs they would OOM on.
+"""
+from datetime import datetime, timedelta
+
+from models import db, Job, Worker
+from sqlalchemy import or_
+
+LEASED_STATUSES = ("accepted", "running")
+TERMINAL_STATUSES = ("completed", "failed", "canceled")
+
+# Give up after this many lost CAS races in a single claim call
+CLAIM_RETRIES = 5
+
+# How far down the priority/FIFO queue best-fit placement looks
+PLACEMENT_WINDOW = 50
+
+
+class JobNotifier:
+    """Wakes long-polling claim requests in this process when a job becomes claimable.
+
+    Waiters grab ``event`` *before* checking the queue and then wait on it;
+    ``notify`` sets the current event and swaps in a fresh one, so a job queued
+    between the check and the wait is never missed. Other server processes are
+    covered by the periodic recheck in the claim loop.
+    """
+
+    def __init__(self, create_event):
+        self._create_event = create_event
+        self.event = create_event()
+
+    def notify(self):
+        event, self.event = self.event, self._create_event()
+        event.set()
+
+
+def _lease_values(worker_id, lease_sec, now):
+    return {
+        "status": "accepted",
+        "accepted_by": worker_id,
+        "lease_expires_at": now + timedelta(seconds=lease_sec),
+        "attempts": Job.attempts + 1,
+        "updated_at": now,
+    }
+
+
+def free_capacity(worker):
+    """What ``worker`` has left after the requests of jobs already leased to it.
+
+    Returns a dict with ``cpus``, ``memory_mb`` and ``disk_mb``; a value is None
+    when the worker never reported it (no constraint is applied then).
+    """
+    cpus, mem, disk = (db.session.query(
+        db.func.coalesce(db.func.sum(Job.req_cpus), 0),
+        db.func.coalesce(db.func.sum(Job.req_memory_mb), 0),
+        db.func.coalesce(db.func.sum(Job.req_disk_mb), 0))
+        .filter(Job.accepted_by == worker.id, Job.status.in_(LEASED_STATUSES)).one())
+    free = {"cpus": None, "memory_mb": None, "disk_mb": None}
+    if worker.cpu_count:
+        free["cpus"] = worker.cpu_count - cpus
+    if worker.mem_total_mb:
+        free["memory_mb"] = worker.mem_total_mb - mem
+        if worker.mem_available_mb is not None:
+            free["memory_mb"] = min(free["memory_mb"], worker.mem_available_mb)
+    if worker.disk_free_mb is not None:
+        free["disk_mb"] = worker.disk_free_mb
+    return free
+
+
+def _fits(query, free):
+    for column, key in ((Job.req_cpus, "cpus"), (Job.req_memory_mb, "memory_mb"), (Job.req_disk_mb, "disk_mb")):
+        if free.get(key) is not None:
+            query = query.filter(or_(column.is_(None), column <= free[key]))
+    return query
+
+
+def _leftover(row, free):
+    """Fraction of the worker's free resources a job would leave unused (lower = tighter fit)."""
+    score = 0.0
+    for req, key in ((row.req_cpus, "cpus"), (row.req_memory_mb, "memory_mb")):
+        avail = free.get(key)
+        if avail:
+            score += 1.0 - (req or 0) / avail
+    return score
+
+
+def claim_next_job(worker_id, lease_sec, free=None):
+    """Lease the best eligible pending job to ``worker_id``; None if nothing fits.
+
+    ``free`` is the worker's spare capacity (see ``free_capacity``); without it
+    the plain priority/FIFO head of the queue is taken.
+    """
+    free = free or {}
+    for _ in range(CLAIM_RETRIES):
+        q = (db.session.query(Job.id, Job.priority, Job.created_at, Job.req_cpus, Job.req_memory_mb)
+             .filter(Job.status == "pending"))
+        rows = (_fits(q, free)
+                .order_by(Job.priority.desc(), Job.created_at.asc(), Job.id.asc())
+                .limit(PLACEMENT_WINDOW).all())
+        if not rows:
+            return None
+        # Best fit among the fitting jobs of the highest waiting priority; FIFO breaks ties
+        top = [r for r in rows if r.priority == rows[0].priority]
+        ranked = sorted(top, key=lambda r: _leftover(r, free)) if any(free.values()) else top
+        for row in ranked:
+            if claim_job(row.id, worker_id, lease_sec):
+                return db.session.get(Job, row.id)
+    return None
+
+
+def claim_job(job_id, worker_id, lease_sec):
+    """Lease one specific job if it is still pending. Returns True if we won it."""
+    now = datetime.utcnow()
+    res = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.status == "pending")
+        .values(**_lease_values(worker_id, lease_sec, now))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if res.rowcount == 1:
+        db.session.expire_all()
+        return True
+    return False
+
+
+def renew_lease(job_id, worker_id, lease_sec):
+    """Extend the lease of a job the worker holds. Returns False if it lost the lease."""
+    res = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.accepted_by == worker_id, Job.status.in_(LEASED_STATUSES))
+        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_sec))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return res.rowcount == 1
+
+
+def report_status(job_id, worker_id, status, lease_sec):
+    """Store a status reported by the worker holding the job; any report renews the lease.
+
+    Returns the status stored, or None if ``worker_id`` no longer holds the job
+    (its lease expired and the job was requeued, canceled or taken by another
+    worker). A job with a pending cancellation ends as ``canceled`` whatever
+    terminal status is reported.
+    """
+    now = datetime.utcnow()
+    if status in TERMINAL_STATUSES:
+        values = {"status": db.case((Job.cancel_requested_at.is_not(None), "canceled"), else_=status),
+                  "lease_expires_at": None}
+    else:
+        values = {"status": status, "lease_expires_at": now + timedelta(seconds=lease_sec)}
+    res = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.accepted_by == worker_id, Job.status.in_(LEASED_STATUSES))
+        .values(updated_at=now, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if res.rowcount != 1:
+        return None
+    db.session.expire_all()
+    return db.session.query(Job.status).filter(Job.id == job_id).scalar()
+
+
+def renew_leases(worker_id, job_ids, lease_sec):
+    """Heartbeat renewal of every job a worker holds.
+
+    Returns ``{job_id: cancel_requested}`` for the ids that are still its own.
+    """
+    if not job_ids:
+        return {}
+    db.session.execute(
+        db.update(Job)
+        .where(Job.id.in_(job_ids), Job.accepted_by == worker_id, Job.status.in_(LEASED_STATUSES))
+        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_sec))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    held = (db.session.query(Job.id, Job.cancel_requested_at)
+            .filter(Job.id.in_(job_ids), Job.accepted_by == worker_id, Job.status.in_(LEASED_STATUSES)))
+    return {job_id: requested is not None for job_id, requested in held}
+
+
+def cancel_job(job_id):
+    """Cancel a job. Returns ``(status, changed)``; status is None if the job doesn't exist.
+
+    A pending job is canceled on the spot. A leased one is only flagged
+    (``cancel_requested_at``); its worker learns about it from the next
+    heartbeat or log upload, stops the container and reports ``canceled``.
+    """
+    now = datetime.utcnow()
+    res = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.status == "pending")
+        .values(status="canceled", cancel_requested_at=now, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    changed = res.rowcount == 1
+    if not changed:
+        res = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status.in_(LEASED_STATUSES), Job.cancel_requested_at.is_(None))
+            .values(cancel_requested_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        changed = res.rowcount == 1
+    db.session.commit()
+    db.session.expire_all()
+    return db.session.query(Job.status).filter(Job.id == job_id).scalar(), changed
+
+
+def mark_offline_workers(timeout_sec):
+    """Flag workers silent for ``timeout_sec`` as offline and expire their leases.
+
+    The expired jobs are then picked up by ``requeue_expired``. Returns the
+    names of the workers that just went offline.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=timeout_sec)
+    stale = (db.session.query(Worker.id, Worker.name)
+             .filter(Worker.status != "offline", Worker.last_seen < cutoff).all())
+    if not stale:
+        return []
+    ids = [worker_id for worker_id, _ in stale]
+    db.session.execute(
+        db.update(Worker).where(Worker.id.in_(ids), Worker.last_seen < cutoff)
+        .values(status="offline", slots_free=0, running_jobs=0)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        db.update(Job)
+        .where(Job.accepted_by.in_(ids), Job.status.in_(LEASED_STATUSES))
+        .values(lease_expires_at=now - timedelta(seconds=1))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return [name for _, name in stale]
+
+
+def release_job(job_id, worker_id):
+    """Hand a leased job back to the queue without counting it as an attempt."""
+    res = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.accepted_by == worker_id, Job.status.in_(LEASED_STATUSES))
+        .values(status="pending", accepted_by=None, lease_expires_at=None,
+                attempts=Job.attempts - 1, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    db.session.expire_all()
+    return res.rowcount == 1
+
+
+def requeue_expired(max_attempts):
+    """Requeue (or fail, after ``max_attempts``) jobs whose lease has run out.
+
+    Jobs with a pending cancellation are canceled instead of requeued. A
+    leased job without any lease is treated as expired, so it can't get stuck.
+
+    Returns a list of ``(job_id, new_status)`` for the jobs that changed.
+    """
+    now = datetime.utcnow()
+    lapsed = or_(Job.lease_expires_at < now, Job.lease_expires_at.is_(None))
+    expired = (db.session.query(Job.id, Job.attempts, Job.cancel_requested_at)
+               .filter(Job.status.in_(LEASED_STATUSES), lapsed)
+               .all())
+    changed = []
+    for job_id, attempts, cancel_requested in expired:
+        if cancel_requested is not None:
+            new_status = "canceled"  # its worker died before it could stop it
+        elif (attempts or 0) >= max_attempts:
+            new_status = "failed"
+        else:
+            new_status = "pending"
+        res = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status.in_(LEASED_STATUSES), lapsed)
+            .values(status=new_status, accepted_by=None, lease_expires_at=None, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        if res.rowcount == 1:
+            changed.append((job_id, new_status))
+    db.session.commit()
+    if changed:
+        db.session.expire_all()
+    return changed
@@ -0,0 +1,161 @@
+"""Database engine tuning, group commit for log writes and locks for the file-backed stores.
+
+SQLite (the default) is switched to WAL journaling with ``synchronous=NORMAL``:
+readers no longer block the writer and a commit is an append to the WAL instead
+of an fsync of the main file. Together with a busy timeout this removes the
+``database is locked`` stalls seen with several workers streaming at once.
+Any other URL (e.g. ``postgresql+psycopg2://...``) only gets a connection pool
+sized for the number of greenlets eventlet runs concurrently.
+"""
+import os, hashlib, tempfile, threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no multi-process deployment anyway
+    fcntl = None
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+SQLITE_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def engine_options(config):
+    """``SQLALCHEMY_ENGINE_OPTIONS`` for the configured database URL."""
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite":
+        opts = {"connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT_MS"] / 1000.0}}
+        if url.database in (None, "", ":memory:"):
+            return opts  # Flask-SQLAlchemy pins in-memory databases to a single connection
+    else:
+        # Drop connections the server closed while idle instead of failing a request
+        opts = {"pool_pre_ping": True, "pool_recycle": 1800}
+    opts.update(pool_size=config["DB_POOL_SIZE"], max_overflow=config["DB_MAX_OVERFLOW"],
+                pool_timeout=config["DB_POOL_TIMEOUT_SEC"])
+    return opts
+
+
+def tune_sqlite(engine, config):
+    """Apply the SQLite PRAGMAs to every new connection of ``engine``."""
+    if engine.dialect.name != "sqlite":
+        return
+    synchronous = config["SQLITE_SYNCHRONOUS"].upper()
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"SQLITE_SYNCHRONOUS must be one of {sorted(SQLITE_SYNCHRONOUS_MODES)}")
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        if config["SQLITE_WAL"]:
+            cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(f"PRAGMA synchronous={synchronous}")
+        cur.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cur.close()
+
+
+@contextmanager
+def startup_lock(database_uri):
+    """Serialize schema upgrades and backfills between processes booting together on one host.
+
+    Deployments spread over several hosts should run ``python migrations.py``
+    once before starting the new release.
+    """
+    if fcntl is None:
+        yield
+        return
+    digest = hashlib.sha1(database_uri.encode()).hexdigest()[:12]
+    with open(os.path.join(tempfile.gettempdir(), f"dtrain-startup-{digest}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DirLocks:
+    """Exclusive per-directory locks for the file-backed stores (job logs, metrics).
+
+    ``hold(folder)`` takes a thread lock for callers in this process and an
+    ``flock`` on ``folder/.lock`` for other server processes sharing the folder.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, folder):
+        with self._guard:
+            lock = self._locks.setdefault(folder, threading.Lock())
+        with lock:
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, ".lock"), "a") as lf:
+                if fcntl is not None:
+                    fcntl.flock(lf, fcntl.LOCK_EX)
+                yield folder
+
+
+class _Batch:
+    def __init__(self, done):
+        self.rows = []
+        self.done = done
+        self.error = None
+
+
+class GroupCommitter:
+    """Folds concurrent log appends into a single INSERT + COMMIT.
+
+    The first caller to arrive leads a batch: it sleeps for ``window_sec`` while
+    other greenlets add their rows, then writes the whole batch with ``write``
+    and wakes them. Every caller returns only once its rows are committed (or
+    re-raises the batch's error), so the durability of a single append is
+    unchanged. A batch that reaches ``max_rows`` stops accepting rows and the
+    next caller starts a new one. ``window_sec=0`` writes each append directly.
+    """
+
+    def __init__(self, write, create_event, sleep, window_sec, max_rows):
+        self._write = write
+        self._create_event = create_event
+        self._sleep = sleep
+        self.window_sec = window_sec
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._batch = None
+        self.batches = 0
+        self.rows = 0
+
+    def append(self, rows):
+        if not rows:
+            return
+        if self.window_sec <= 0:
+            self._flush(rows)
+            return
+        with self._lock:
+            batch = self._batch
+            leader = batch is None or len(batch.rows) >= self.max_rows
+            if leader:
+                batch = self._batch = _Batch(self._create_event())
+            batch.rows.extend(rows)
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+        try:
+            if len(batch.rows) < self.max_rows:
+                self._sleep(self.window_sec)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None  # close it: late arrivals start the next batch
+            self._flush(batch.rows)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+
+    def _flush(self, rows):
+        self._write(rows)
+        self.batches += 1
+        self.rows += len(rows)
@@ -0,0 +1,143 @@
+"""Chunked, resumable artifact uploads streamed straight to disk.
+
+Protocol (all under ``/api/jobs/<id>/uploads``):
+
+1. ``POST``                      ``{"filename", "size", "sha256"}`` -> ``{"upload_id", "offset"}``
+2. ``PUT  /<upload_id>?offset=N`` raw bytes; appended only if N equals the bytes
+   already received, otherwise 409 with the server's offset so the client can resync
+3. ``GET  /<upload_id>``          -> ``{"offset"}`` (resume point after a failure)
+4. ``POST /<upload_id>/complete`` verifies size/sha256 and moves the file into place
+
+State lives entirely on disk next to the finished artifacts: ``<id>.part`` is the
+data received so far (its size *is* the acknowledged offset) and ``<id>.json``
+the metadata from step 1, so any server process sharing the folder can resume it.
+Uploads that see no chunk for a while are deleted by ``sweep_stale``.
+"""
+import os, json, time, uuid, hashlib, re
+
+from werkzeug.utils import secure_filename
+
+PARTIAL_DIR = ".partial"
+COPY_CHUNK = 1024 * 1024
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_SHA256 = re.compile(r"^[0-9a-fA-F]{64}$")
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _paths(folder, upload_id):
+    if not _UPLOAD_ID.match(upload_id or ""):
+        raise UploadError("unknown upload", 404)
+    base = os.path.join(folder, PARTIAL_DIR, upload_id)
+    return base + ".part", base + ".json"
+
+
+def _load_meta(folder, job_id, upload_id):
+    part, meta_path = _paths(folder, upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        raise UploadError("unknown upload", 404)
+    if meta["job_id"] != job_id:
+        raise UploadError("unknown upload", 404)
+    return part, meta_path, meta
+
+
+def init_upload(folder, job_id, filename, size=None, sha256=None):
+    if size is not None and (isinstance(size, bool) or not isinstance(size, int) or size < 0):
+        raise UploadError("size must be a non-negative integer")
+    if sha256 is not None and not (isinstance(sha256, str) and _SHA256.match(sha256)):
+        raise UploadError("sha256 must be 64 hex characters")
+    os.makedirs(os.path.join(folder, PARTIAL_DIR), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    part, meta_path = _paths(folder, upload_id)
+    meta = {"job_id": job_id, "filename": secure_filename(filename or "artifact") or "artifact",
+            "size": size, "sha256": sha256.lower() if sha256 else None}
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    open(part, "wb").close()
+    return upload_id
+
+
+def upload_offset(folder, job_id, upload_id):
+    part, _, _ = _load_meta(folder, job_id, upload_id)
+    return os.path.getsize(part)
+
+
+def write_chunk(folder, job_id, upload_id, offset, stream):
+    """Append ``stream`` at ``offset``; returns the new offset."""
+    part, _, meta = _load_meta(folder, job_id, upload_id)
+    current = os.path.getsize(part)
+    if offset != current:
+        raise UploadError("offset mismatch", 409, offset=current)
+    with open(part, "ab") as f:
+        while True:
+            chunk = stream.read(COPY_CHUNK)
+            if not chunk:
+                break
+            f.write(chunk)
+        new_offset = f.tell()
+    if meta.get("size") is not None and new_offset > meta["size"]:
+        # Roll back the overflow so the client can retry from a sane offset
+        with open(part, "ab") as f:
+            f.truncate(current)
+        raise UploadError("chunk exceeds declared size", 400, offset=current)
+    return new_offset
+
+
+def complete_upload(folder, job_id, upload_id, sha256=None):
+    """Verify the received bytes and move them into place. Returns ``(filename, size, sha256)``."""
+    part, meta_path, meta = _load_meta(folder, job_id, upload_id)
+    size = os.path.getsize(part)
+    if meta.get("size") is not None and size != meta["size"]:
+        raise UploadError("upload incomplete", 409, offset=size)
+    digest = hashlib.sha256()
+    with open(part, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            digest.update(chunk)
+    actual = digest.hexdigest()
+    expected = sha256 or meta.get("sha256")
+    if isinstance(expected, str):
+        expected = expected.lower()
+    if expected and expected != actual:
+        # Corrupt: throw it away so the client restarts from zero
+        os.remove(part)
+        os.remove(meta_path)
+        raise UploadError("checksum mismatch", 422, offset=0)
+    fname = secure_filename(f"job_{job_id}_" + meta["filename"])
+    os.replace(part, os.path.join(folder, fname))
+    os.remove(meta_path)
+    return fname, size, actual
+
+
+def sweep_stale(folder, max_age_sec, now=None):
+    """Delete uploads that received nothing for ``max_age_sec``. Returns their ids."""
+    now = time.time() if now is None else now
+    partial = os.path.join(folder, PARTIAL_DIR)
+    try:
+        names = os.listdir(partial)
+    except FileNotFoundError:
+        return []
+    last_seen = {}
+    for name in names:
+        upload_id, ext = os.path.splitext(name)
+        if ext in (".part", ".json") and _UPLOAD_ID.match(upload_id):
+            try:
+                mtime = os.path.getmtime(os.path.join(partial, name))
+            except FileNotFoundError:
+                continue  # completed meanwhile
+            last_seen[upload_id] = max(last_seen.get(upload_id, 0), mtime)
+    stale = [upload_id for upload_id, mtime in last_seen.items() if now - mtime > max_age_sec]
+    for upload_id in stale:
+        for path in _paths(folder, upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return stale
@@ -1,13 +1,74 @@
-import os, zipfile, uuid
+import os, io, zipfile, uuid, hashlib, zlib
 from flask import current_app
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
-def save_upload(file_storage, subdir=""):
-    os.makedirs(current_app.config["JOB_BUNDLES_FOLDER"], exist_ok=True)
-    unique = uuid.uuid4().hex
-    filename = f"{unique}.zip"
-    path = os.path.join(current_app.config["JOB_BUNDLES_FOLDER"], filename)
-    file_storage.save(path)
-    return filename, path
+HASH_CHUNK = 1024 * 1024
+
+class BundleError(ValueError):
+    """An uploaded job bundle is not an acceptable zip."""
+
+def validate_bundle(path, max_files, max_uncompressed):
+    """Check a bundle's central directory without extracting it.
+
+    Rejects archives that aren't zips, have more than ``max_files`` entries,
+    declare more than ``max_uncompressed`` bytes, or contain absolute/``..``
+    paths or symlinks. Workers re-check all of this (and count real bytes)
+    when they extract.
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+    except (zipfile.BadZipFile, OSError):
+        raise BundleError("bundle is not a valid zip file")
+    if len(infos) > max_files:
+        raise BundleError(f"bundle has {len(infos)} entries (limit {max_files})")
+    total = 0
+    for info in infos:
+        name = info.filename.replace("\\", "/")
+        if name.startswith("/") or "\0" in name or (len(name) > 1 and name[1] == ":") or ".." in name.split("/"):
+            raise BundleError(f"unsafe path in bundle: {info.filename!r}")
+        if (info.external_attr >> 16) & 0o170000 == 0o120000:
+            raise BundleError(f"symlink in bundle: {info.filename!r}")
+        total += info.file_size
+    if total > max_uncompressed:
+        raise BundleError(f"bundle expands to {total} bytes (limit {max_uncompressed})")
+
+def save_upload(file_storage, subdir="", validate=None, max_bytes=None):
+    """Store a bundle content-addressed as ``<sha256>.zip``; identical uploads share one file.
+
+    ``validate(tmp_path)`` runs before the file is moved into place; if it
+    raises (or the upload exceeds ``max_bytes``) the partial file is removed and
+    the error propagates. Returns ``(filename, path, sha256)``.
+    """
+    folder = current_app.config["JOB_BUNDLES_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f".upload-{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = file_storage.stream.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise BundleError(f"bundle exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+        if validate is not None:
+            validate(tmp_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    sha256 = digest.hexdigest()
+    filename = f"{sha256}.zip"
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return filename, path, sha256
 
 def zip_dir(source_dir, out_zip_path):
     with zipfile.ZipFile(out_zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
@@ -16,3 +77,59 @@ def zip_dir(source_dir, out_zip_path):
                 abs_path = os.path.join(root, f)
                 rel_path = os.path.relpath(abs_path, source_dir)
                 zf.write(abs_path, rel_path)
+
+class GzipRequestMiddleware:
+    """WSGI middleware that inflates request bodies sent with ``Content-Encoding: gzip``.
+
+    Workers gzip large log/status payloads. The body is inflated chunk by chunk
+    straight from the input stream: a request whose compressed body exceeds
+    ``max_input`` (or has no length at all) or whose output passes ``max_size``
+    gets a 413 before it is buffered, so a compressed bomb can't exhaust memory.
+    """
+
+    def __init__(self, app, max_size, max_input=None):
+        self.app = app
+        self.max_size = max_size
+        self.max_input = max_input
+
+    def _inflate(self, stream, length):
+        """Inflate at most ``length`` compressed bytes (``max_input`` for a body without a length)."""
+        capped = length is None
+        if capped:
+            length = self.max_input
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out, size, remaining = [], 0, length
+        while not inflater.eof and (remaining is None or remaining > 0):
+            chunk = stream.read(HASH_CHUNK if remaining is None else min(HASH_CHUNK, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            data = inflater.decompress(chunk, self.max_size - size + 1)
+            size += len(data)
+            if size > self.max_size or inflater.unconsumed_tail:
+                raise RequestEntityTooLarge()
+            out.append(data)
+        if not inflater.eof:
+            if capped and remaining == 0:
+                raise RequestEntityTooLarge()
+            raise BadRequest("truncated gzip body")
+        return b"".join(out)
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+            length = int(environ.get("CONTENT_LENGTH") or 0) or None
+            if length is None and not environ.get("wsgi.input_terminated"):
+                return RequestEntityTooLarge()(environ, start_response)
+            if self.max_input is not None and (length or 0) > self.max_input:
+                return RequestEntityTooLarge()(environ, start_response)
+            try:
+                data = self._inflate(environ["wsgi.input"], length)
+            except zlib.error:
+                return BadRequest("invalid gzip body")(environ, start_response)
+            except (BadRequest, RequestEntityTooLarge) as e:
+                return e(environ, start_response)
+            environ["wsgi.input"] = io.BytesIO(data)
+            environ["CONTENT_LENGTH"] = str(len(data))
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.app(environ, start_response)
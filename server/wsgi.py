@@ -0,0 +1,10 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn's eventlet worker monkey-patches the process before importing this
+module, so the app and its background tasks run on green threads.
+"""
+from app import create_app
+
+app, socketio = create_app()
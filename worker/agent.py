@@ -1,6 +1,10 @@
-import os, time, io, zipfile, tempfile, shutil, subprocess, json, sys
+import os, time, io, zipfile, tempfile, shutil, subprocess, json, sys, threading, collections, itertools, random, hashlib, fnmatch, gzip
+import contextlib, math, re
+import concurrent.futures
 from urllib.parse import urljoin
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
 # import cloudinary
 # import cloudinary.uploader
 
@@ -18,23 +22,203 @@ def load_config():
     with open(CONFIG_PATH, "r") as f:
         return json.load(f)
 
+# -------- HTTP client --------
+class CountingRetry(Retry):
+    """urllib3 Retry that reports each retry to the owning HttpClient.
+
+    Only counted once ``increment`` returns: it raises for errors that are not
+    retried and when the budget is exhausted, and no retry happens then.
+    """
+
+    on_retry = None
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        if CountingRetry.on_retry:
+            CountingRetry.on_retry()
+        return retry
+
+class HttpClient:
+    """One keep-alive connection pool shared by every request the agent makes.
+
+    Connection failures are retried with exponential backoff for every method;
+    read errors and 502/503/504 only for idempotent ones (GET/PUT/...), so a
+    log batch is never double-posted by the transport. JSON bodies of at least
+    ``http_compress_min_bytes`` are gzip-compressed.
+    """
+
+    def __init__(self, cfg):
+        self.base_url = cfg["server_url"]
+        self.compress_min = cfg.get("http_compress_min_bytes", 1024) if cfg.get("http_compression", True) else None
+        # Enough connections for every job's log shipper plus parallel uploads and the heartbeat
+        default_pool = cfg.get("upload_parallelism", 4) + 2 * cfg.get("max_concurrent_jobs", 1) + 4
+        retries = cfg.get("http_retries", 3)
+        retry = CountingRetry(
+            total=retries, connect=retries, read=retries, status=retries,
+            backoff_factor=cfg.get("http_backoff_factor", 0.5),
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=cfg.get("http_pool_connections", 4),
+            pool_maxsize=cfg.get("http_pool_maxsize") or default_pool,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.headers["Authorization"] = f"Bearer {cfg['token']}"
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        CountingRetry.on_retry = lambda: self._count("retries")
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", 60)
+        self._count("requests")
+        try:
+            return self.session.request(method, urljoin(self.base_url, path), **kwargs)
+        except requests.RequestException:
+            self._count("errors")
+            raise
+
+    def post_json(self, path, body, timeout=60):
+        data = json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        self._count("body_bytes_raw", len(data))
+        if self.compress_min is not None and len(data) >= self.compress_min:
+            data = gzip.compress(data, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        self._count("body_bytes_sent", len(data))
+        return self.request("POST", path, data=data, headers=headers, timeout=timeout)
+
+    def stats(self):
+        """Connection reuse and transfer counters for this agent process."""
+        opened = served = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+        with self._lock:
+            out = dict(self.counters)
+        out.update({
+            "connections_opened": opened,
+            "pool_requests": served,
+            "connection_reuse_rate": round(1 - opened / served, 3) if served else 0.0,
+        })
+        if out.get("body_bytes_raw"):
+            out["compression_ratio"] = round(out["body_bytes_sent"] / out["body_bytes_raw"], 3)
+        return out
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def http_client(cfg):
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient(cfg)
+        return _http_client
+
+def report_http_stats(cfg):
+    interval = cfg.get("http_stats_interval_sec", 300)
+    while interval:
+        time.sleep(interval)
+        print(f"HTTP stats: {http_client(cfg).stats()}", flush=True)
+
+# -------- Prometheus exporter --------
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily
+except Exception:
+    prometheus_client = None
+
+if prometheus_client is not None:
+    JOB_PHASE_SECONDS = prometheus_client.Histogram(
+        "dtrain_worker_job_phase_seconds", "Time spent in each phase of a job", ["phase"],
+        buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600))
+    JOBS_FINISHED = prometheus_client.Counter("dtrain_worker_jobs_total", "Jobs finished by this agent", ["status"])
+    LOG_BATCH_LINES = prometheus_client.Histogram(
+        "dtrain_worker_log_batch_lines", "Lines per log batch delivered",
+        buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+    LOG_BATCH_BYTES = prometheus_client.Histogram(
+        "dtrain_worker_log_batch_bytes", "Characters per log batch delivered",
+        buckets=(1024, 8192, 65536, 262144, 1024 * 1024, 4 * 1024 * 1024))
+else:
+    JOB_PHASE_SECONDS = JOBS_FINISHED = LOG_BATCH_LINES = LOG_BATCH_BYTES = None
+
+class HttpStatsCollector:
+    """Exports the shared HttpClient's counters (requests, errors, urllib3 retries, bytes) at scrape time."""
+
+    HELP = {"requests": "HTTP requests sent to the server", "errors": "HTTP requests that failed at the transport",
+            "retries": "HTTP retries done by the transport", "body_bytes_raw": "JSON request bytes before compression",
+            "body_bytes_sent": "JSON request bytes sent"}
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def collect(self):
+        stats = http_client(self.cfg).stats()
+        for key, text in self.HELP.items():
+            yield CounterMetricFamily(f"dtrain_worker_http_{key}", text, value=stats.get(key, 0))
+
+def start_exporter(cfg, slots):
+    """Serve Prometheus metrics on ``prometheus_port``; off when unset or prometheus_client is missing."""
+    port = cfg.get("prometheus_port")
+    if not port:
+        return
+    if prometheus_client is None:
+        print("prometheus_port is set but prometheus_client is not installed; metrics disabled", flush=True)
+        return
+    prometheus_client.REGISTRY.register(HttpStatsCollector(cfg))
+    gauge = prometheus_client.Gauge("dtrain_worker_slots", "Job slots of this agent", ["state"])
+    gauge.labels("total").set(slots.size)
+    gauge.labels("free").set_function(lambda: slots.free)
+    prometheus_client.start_http_server(int(port), addr=cfg.get("prometheus_bind", "0.0.0.0"))
+    print(f"Prometheus metrics on :{port}/metrics", flush=True)
+
+@contextlib.contextmanager
+def job_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if JOB_PHASE_SECONDS is not None:
+            JOB_PHASE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
 def api_get(cfg, path):
-    url = urljoin(cfg["server_url"], path)
-    headers = {"Authorization": f"Bearer {cfg['token']}"}
-    r = requests.get(url, headers=headers, timeout=30)
+    r = http_client(cfg).request("GET", path, timeout=30)
     r.raise_for_status()
     return r.json()
 
-def api_post(cfg, path, json_body=None):
-    url = urljoin(cfg["server_url"], path)
-    headers = {"Authorization": f"Bearer {cfg['token']}", "Content-Type": "application/json"}
-    r = requests.post(url, headers=headers, json=json_body, timeout=60)
+def api_post(cfg, path, json_body=None, timeout=60):
+    r = http_client(cfg).post_json(path, json_body, timeout=timeout)
     r.raise_for_status()
     try:
         return r.json()
     except Exception:
         return {}
 
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def claim_job(cfg, slots):
+    """Long-poll the server for the next job. Returns the job dict or None when idle."""
+    wait = cfg.get("claim_wait_sec", 25)
+    # Fresh load figures let the server place only jobs whose resource requests fit
+    body = {"worker_name": cfg["worker_name"], "wait": wait, "slots_total": slots.size, "slots_free": slots.free,
+            **system_load()}
+    return api_post(cfg, "/api/jobs/claim", body, timeout=wait + 30) or None
+
 def ask_user_acceptance(job):
     """Ask user if they want to accept this job"""
     print(f"\n{'='*50}")
@@ -59,19 +243,155 @@ def download_bundle(cfg, bundle_filename, out_path):
     # We'll receive the direct /api/jobs/<id>/download route.
     raise RuntimeError("Use download_job_by_id instead")
 
-def download_job_by_id(cfg, job_id, out_zip):
-    url = urljoin(cfg["server_url"], f"/api/jobs/{job_id}/download")
-    headers = {"Authorization": f"Bearer {cfg['token']}"}
-    with requests.get(url, headers=headers, timeout=300, stream=True) as r:
+MIN_DOWNLOAD_CHUNK = 64 * 1024
+MAX_DOWNLOAD_CHUNK = 4 * 1024 * 1024
+
+def download_chunk_size(content_length):
+    """Read size for a download: ~64 reads per body, between 64 KB and 4 MB."""
+    if not content_length:
+        return 1024 * 1024
+    return max(MIN_DOWNLOAD_CHUNK, min(MAX_DOWNLOAD_CHUNK, content_length // 64))
+
+def download_job_by_id(cfg, job_id, out_zip, expected_sha256=None):
+    """Download a job bundle, hashing and size-checking it on the way in. Returns the sha256 hex digest."""
+    max_bytes = int(cfg.get("bundle_max_mb", 512)) * 1024 * 1024
+    digest = hashlib.sha256()
+    received = 0
+    with http_client(cfg).request("GET", f"/api/jobs/{job_id}/download", timeout=300, stream=True) as r:
         r.raise_for_status()
+        length = int(r.headers.get("Content-Length") or 0)
+        if length > max_bytes:
+            raise RuntimeError(f"Bundle for job {job_id} is {length} bytes, over bundle_max_mb")
         with open(out_zip, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+            for chunk in r.iter_content(chunk_size=download_chunk_size(length)):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise RuntimeError(f"Bundle for job {job_id} exceeds bundle_max_mb")
+                digest.update(chunk)
+                f.write(chunk)
+    if expected_sha256 and digest.hexdigest() != expected_sha256:
+        raise RuntimeError(f"Bundle for job {job_id} failed integrity check")
+    return digest.hexdigest()
+
+class BundleCache:
+    """Local content-addressed cache of job bundles (``<sha256>.zip``).
+
+    Resubmitted bundles are extracted straight from the cache without touching
+    the network. Oldest-used bundles are pruned past ``bundle_cache_max_mb``.
+    """
+
+    def __init__(self, cfg):
+        self.dir = cfg.get("bundle_cache_dir") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "bundle_cache")
+        self.max_bytes = int(cfg.get("bundle_cache_max_mb", 2048)) * 1024 * 1024
+        self._locks = collections.defaultdict(threading.Lock)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def fetch(self, cfg, job):
+        """Return a local path to the job's bundle, downloading only on a cache miss."""
+        sha = job.get("bundle_sha256")
+        if not sha:
+            # Server didn't give us a hash: download into the cache under the computed one
+            tmp = os.path.join(self.dir, f".job_{job['id']}_{threading.get_ident()}.tmp")
+            try:
+                sha = download_job_by_id(cfg, job["id"], tmp)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            return self._commit(tmp, sha)
+        with self._locks[sha]:
+            path = os.path.join(self.dir, f"{sha}.zip")
+            if os.path.exists(path):
+                print(f"Bundle cache hit for job {job['id']}", flush=True)
+                os.utime(path)
+                return path
+            tmp = path + f".{threading.get_ident()}.tmp"
+            try:
+                download_job_by_id(cfg, job["id"], tmp, expected_sha256=sha)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            return self._commit(tmp, sha)
 
-def decompress(zip_path, dest_dir):
-    with zipfile.ZipFile(zip_path, 'r') as zf:
-        zf.extractall(dest_dir)
+    def _commit(self, tmp, sha):
+        path = os.path.join(self.dir, f"{sha}.zip")
+        os.replace(tmp, path)
+        self._prune(keep=path)
+        return path
+
+    def _prune(self, keep):
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.endswith(".zip"):
+                p = os.path.join(self.dir, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+
+class BundleError(RuntimeError):
+    pass
+
+def unsafe_member_name(name):
+    """True for zip entry names that could escape the extraction directory."""
+    name = name.replace("\\", "/")
+    if not name or "\0" in name or name.startswith("/") or (len(name) > 1 and name[1] == ":"):
+        return True
+    return ".." in name.split("/")
+
+def decompress(zip_path, dest_dir, max_files=10000, max_bytes=4096 * 1024 * 1024):
+    """Extract a bundle with limits on entry count and total size.
+
+    The central directory is checked before anything is written: absolute or
+    ``..`` paths, symlinks, too many entries or too many declared bytes reject
+    the whole bundle. Members are then streamed out with a running byte count,
+    so a header that under-reports its size can't blow past ``max_bytes``.
+    """
+    dest_root = os.path.realpath(dest_dir)
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        infos = zf.infolist()
+        if len(infos) > max_files:
+            raise BundleError(f"bundle has {len(infos)} entries (limit {max_files})")
+        declared = 0
+        for info in infos:
+            if unsafe_member_name(info.filename):
+                raise BundleError(f"unsafe path in bundle: {info.filename!r}")
+            if (info.external_attr >> 16) & 0o170000 == 0o120000:
+                raise BundleError(f"symlink in bundle: {info.filename!r}")
+            declared += info.file_size
+        if declared > max_bytes:
+            raise BundleError(f"bundle expands to {declared} bytes (limit {max_bytes})")
+        written = 0
+        for info in infos:
+            target = os.path.realpath(os.path.join(dest_root, info.filename))
+            if target != dest_root and not target.startswith(dest_root + os.sep):
+                raise BundleError(f"unsafe path in bundle: {info.filename!r}")
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zf.open(info) as src, open(target, "wb") as out:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise BundleError(f"bundle expands past {max_bytes} bytes")
+                    out.write(chunk)
 
 def send_logs(cfg, job_id, lines):
     if not lines:
@@ -81,7 +401,432 @@ def send_logs(cfg, job_id, lines):
     except Exception as e:
         print(f"Failed to send logs: {e}", flush=True)
 
-def build_image(context_dir, tag):
+def post_status(cfg, job_id, status, note):
+    # The server only accepts reports from the worker that holds the job's lease
+    api_post(cfg, f"/api/jobs/{job_id}/status", {"status": status, "note": note, "worker_name": cfg["worker_name"]})
+
+class LogShipper:
+    """Collects container output lines and ships them to the server in batches.
+
+    A batch is sealed when it reaches ``log_batch_max_lines`` lines,
+    ``log_batch_max_bytes`` bytes or has been open for ``log_flush_interval_sec``.
+    Sealed batches are sent in order by a background thread; a failed batch is
+    retried (with backoff) before anything behind it is sent. When more than
+    ``log_max_pending_batches`` batches are waiting, new batches are spilled to
+    ``log_spill_dir`` and once ``log_spill_max_bytes`` is reached ``add`` blocks
+    until the server catches up.
+    """
+
+    _spill_seq = itertools.count()
+
+    def __init__(self, cfg, job_id, control=None):
+        self.cfg = cfg
+        self.job_id = job_id
+        self.control = control
+        self.max_lines = cfg.get("log_batch_max_lines", 500)
+        self.max_bytes = cfg.get("log_batch_max_bytes", 256 * 1024)
+        self.flush_interval = cfg.get("log_flush_interval_sec", 1.0)
+        self.max_pending = cfg.get("log_max_pending_batches", 64)
+        self.spill_dir = cfg.get("log_spill_dir") or os.path.join(tempfile.gettempdir(), "dtrain_log_spill")
+        self.spill_max_bytes = cfg.get("log_spill_max_bytes", 512 * 1024 * 1024)
+        self.retry_max_sec = cfg.get("log_retry_max_sec", 30)
+        self.drain_timeout = cfg.get("log_drain_timeout_sec", 60)
+
+        self._cond = threading.Condition()
+        self._buf = []
+        self._buf_bytes = 0
+        self._buf_opened = None
+        # Ordered queue of sealed batches: either a list of lines kept in
+        # memory or the path of a spilled JSON file.
+        self._queue = collections.deque()
+        self._in_memory = 0
+        self._spilled_bytes = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"log-shipper-{job_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, line):
+        size = len(line.encode("utf-8", errors="ignore"))
+        with self._cond:
+            while self._spilled_bytes >= self.spill_max_bytes and not self._closed:
+                # Backpressure: the server is too far behind, stall the producer.
+                self._cond.wait(1.0)
+            if not self._buf:
+                self._buf_opened = time.monotonic()
+            self._buf.append(line)
+            self._buf_bytes += size
+            if len(self._buf) >= self.max_lines or self._buf_bytes >= self.max_bytes:
+                self._seal()
+
+    def close(self):
+        """Flush what is buffered and wait (up to ``log_drain_timeout_sec``) for delivery."""
+        with self._cond:
+            self._seal()
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(self.drain_timeout)
+        with self._cond:
+            dropped = len(self._queue)
+            while self._queue:
+                self._discard(self._queue.popleft())
+        if dropped:
+            print(f"Dropped {dropped} undelivered log batches for job {self.job_id}", flush=True)
+
+    # Callers must hold self._cond.
+    def _seal(self):
+        if not self._buf:
+            return
+        batch, self._buf, self._buf_bytes = self._buf, [], 0
+        if self._in_memory < self.max_pending:
+            self._queue.append(batch)
+            self._in_memory += 1
+        else:
+            self._queue.append(self._spill(batch))
+        self._cond.notify_all()
+
+    def _spill(self, batch):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"job_{self.job_id}_{os.getpid()}_{next(self._spill_seq)}.json")
+        with open(path, "w") as f:
+            json.dump(batch, f)
+        self._spilled_bytes += os.path.getsize(path)
+        return path
+
+    def _discard(self, entry):
+        if isinstance(entry, str):
+            try:
+                self._spilled_bytes -= os.path.getsize(entry)
+                os.remove(entry)
+            except OSError:
+                pass
+        else:
+            self._in_memory -= 1
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            with self._cond:
+                while True:
+                    if self._buf:
+                        remaining = self.flush_interval - (time.monotonic() - self._buf_opened)
+                        if remaining <= 0:
+                            self._seal()
+                    if self._queue:
+                        break
+                    if self._closed:
+                        return
+                    self._cond.wait(remaining if self._buf else self.flush_interval)
+                entry = self._queue[0]
+
+            if isinstance(entry, str):
+                try:
+                    with open(entry) as f:
+                        lines = json.load(f)
+                except (OSError, ValueError):
+                    lines = []
+            else:
+                lines = entry
+
+            try:
+                if lines:
+                    resp = api_post(self.cfg, f"/api/jobs/{self.job_id}/logs", {"lines": lines})
+                    if LOG_BATCH_LINES is not None:
+                        LOG_BATCH_LINES.observe(len(lines))
+                        LOG_BATCH_BYTES.observe(sum(len(line) for line in lines))
+                    if resp.get("cancel") and self.control is not None:
+                        self.control.stop("canceled", "Canceled by user")
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and 400 <= status < 500 and status != 429:
+                    # Retrying will not help (job gone, bad token ...); drop the batch.
+                    print(f"Log batch rejected ({status}), dropping {len(lines)} lines", flush=True)
+                else:
+                    print(f"Failed to send logs: {e}", flush=True)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.retry_max_sec)
+                    continue
+            except Exception as e:
+                print(f"Failed to send logs: {e}", flush=True)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.retry_max_sec)
+                continue
+
+            backoff = 0.5
+            with self._cond:
+                if self._queue and self._queue[0] is entry:
+                    self._queue.popleft()
+                    self._discard(entry)
+                self._cond.notify_all()
+
+# -------- Training metrics --------
+DEFAULT_METRIC_PATTERNS = [r"^[Ee]poch\s+(?P<step>\d+)\b", r"^[Ss]tep\s+(?P<step>\d+)\b"]
+METRIC_PAIR = re.compile(r"([A-Za-z_][\w.\-]*)\s*[=:]\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+
+class MetricParser:
+    """Picks metric points out of container output lines.
+
+    * JSON lines: an object with a numeric ``step`` (or ``epoch``) key, e.g.
+      ``{"step": 3, "loss": 0.6}``. Its other numeric fields are the metrics.
+    * ``metric_patterns``: regexes tried in order. Named groups are the values
+      and ``step`` is the step. A pattern with only a ``step`` group takes the
+      ``name=value`` / ``name: value`` pairs after the match, which covers
+      lines like ``Epoch 3: loss=0.600, acc=0.600``.
+
+    Returns ``{"step", "ts", "values"}`` or None.
+    """
+
+    def __init__(self, cfg):
+        patterns = cfg.get("metric_patterns")
+        self.patterns = [re.compile(p) for p in (DEFAULT_METRIC_PATTERNS if patterns is None else patterns)]
+
+    def parse(self, line):
+        line = line.strip()
+        if line.startswith("{"):
+            return self._parse_json(line)
+        for pattern in self.patterns:
+            m = pattern.search(line)
+            if not m:
+                continue
+            groups = {k: v for k, v in m.groupdict().items() if v is not None}
+            step = groups.pop("step", None)
+            if groups:
+                values = {k: _metric_value(v) for k, v in groups.items()}
+            else:
+                values = {k: _metric_value(v) for k, v in METRIC_PAIR.findall(line[m.end():])}
+            values = {k: v for k, v in values.items() if v is not None}
+            if values:
+                return {"step": _metric_value(step), "ts": time.time(), "values": values}
+        return None
+
+    def _parse_json(self, line):
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(obj, dict):
+            return None
+        step = obj.get("step", obj.get("epoch"))
+        if not isinstance(step, (int, float)) or isinstance(step, bool):
+            return None
+        values = {k: float(v) for k, v in obj.items()
+                  if k not in ("step", "epoch", "ts") and isinstance(v, (int, float)) and not isinstance(v, bool)
+                  and math.isfinite(v)}
+        if not values:
+            return None
+        ts = obj.get("ts")
+        return {"step": step, "ts": ts if isinstance(ts, (int, float)) else time.time(), "values": values}
+
+def _metric_value(text):
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+class MetricShipper:
+    """Sends parsed metric points to ``/api/jobs/<id>/metrics`` every ``metrics_flush_interval_sec``.
+
+    Points that fail to send are retried with the next flush; beyond
+    ``metrics_max_buffered`` points the oldest are dropped.
+    """
+
+    def __init__(self, cfg, job_id):
+        self.cfg = cfg
+        self.job_id = job_id
+        self.interval = cfg.get("metrics_flush_interval_sec", 2.0)
+        self._buf = collections.deque(maxlen=cfg.get("metrics_max_buffered", 10000))
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"metrics-{job_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, point):
+        with self._lock:
+            self._buf.append(point)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join(self.interval + 60)
+
+    def _flush(self):
+        with self._lock:
+            points = list(self._buf)
+            self._buf.clear()
+        if not points:
+            return
+        try:
+            api_post(self.cfg, f"/api/jobs/{self.job_id}/metrics", {"points": points})
+        except Exception as e:
+            print(f"Failed to send metrics: {e}", flush=True)
+            with self._lock:
+                # Failed points go back in front of newer ones; past maxlen the oldest fall off
+                self._buf = collections.deque(points + list(self._buf), maxlen=self._buf.maxlen)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self._flush()
+        self._flush()
+
+# -------- Cancellation and timeouts --------
+class JobStopped(Exception):
+    pass
+
+class JobControl:
+    """Whether (and why) a job has to stop early.
+
+    ``reason`` is ``canceled`` (by a user), ``timeout``, ``build_timeout`` or
+    ``lost`` (lease taken away). ``stop`` records the first reason and, on a
+    separate thread, runs whatever was registered with ``stopping`` (kill the
+    build, stop the container) so the job thread blocked on it returns at once.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.reason = None
+        self.note = None
+        self._lock = threading.Lock()
+        self._stopper = None
+
+    def stop(self, reason, note=None):
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason, self.note = reason, note
+            stopper = self._stopper
+        if stopper is not None:
+            threading.Thread(target=self._run_stopper, args=(stopper,), daemon=True).start()
+
+    def check(self):
+        if self.reason is not None:
+            raise JobStopped(self.note or self.reason)
+
+    @contextlib.contextmanager
+    def stopping(self, stopper):
+        """Run ``stopper`` if the job is stopped while inside this block."""
+        with self._lock:
+            self._stopper = stopper
+            stopped = self.reason is not None
+        if stopped:
+            self._run_stopper(stopper)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stopper = None
+
+    def deadline(self, seconds, reason, note):
+        """Stop with ``reason`` after ``seconds``; cancel the returned timer when the phase ends."""
+        timer = threading.Timer(seconds, self.stop, args=(reason, note))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _run_stopper(self, stopper):
+        try:
+            stopper()
+        except Exception as e:
+            print(f"Could not stop job {self.job_id}: {e}", flush=True)
+
+def stopping(control, stopper):
+    return control.stopping(stopper) if control is not None else contextlib.nullcontext()
+
+# -------- Heartbeat --------
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+def system_load(path="."):
+    """CPU %, memory and free disk for the heartbeat; psutil when installed, /proc otherwise."""
+    load = {"cpu_count": os.cpu_count() or 1}
+    if psutil is not None:
+        vm = psutil.virtual_memory()
+        load.update(cpu_percent=psutil.cpu_percent(interval=None),
+                    mem_total_mb=vm.total // 2**20, mem_available_mb=vm.available // 2**20)
+    else:
+        try:
+            load["cpu_percent"] = round(100.0 * os.getloadavg()[0] / load["cpu_count"], 1)
+        except (OSError, AttributeError):
+            pass
+        try:
+            with open("/proc/meminfo") as f:
+                info = {line.split(":")[0]: int(line.split()[1]) for line in f if line.split()[1].isdigit()}
+            load.update(mem_total_mb=info["MemTotal"] // 1024, mem_available_mb=info["MemAvailable"] // 1024)
+        except (OSError, KeyError, IndexError):
+            pass
+    try:
+        load["disk_free_mb"] = shutil.disk_usage(path).free // 2**20
+    except OSError:
+        pass
+    return load
+
+class Heartbeat:
+    """Reports liveness and load every ``heartbeat_interval_sec`` and keeps job leases alive.
+
+    Every job the agent holds (claimed, awaiting acceptance or running) is
+    registered with ``hold``; each beat renews all of their leases in one
+    request. If the server answers that a job is no longer ours (it was
+    requeued after we went quiet) or that a user canceled it, the
+    ``JobControl`` returned by ``hold`` is stopped.
+    """
+
+    def __init__(self, cfg, slots):
+        self.cfg = cfg
+        self.slots = slots
+        self.interval = cfg.get("heartbeat_interval_sec", 15)
+        self._lock = threading.Lock()
+        self._held = {}
+        self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def hold(self, job_id):
+        control = JobControl(job_id)
+        with self._lock:
+            self._held[job_id] = control
+        return control
+
+    def drop(self, job_id):
+        with self._lock:
+            self._held.pop(job_id, None)
+
+    def beat(self):
+        with self._lock:
+            held = list(self._held)
+        body = {"name": self.cfg["worker_name"], "slots_total": self.slots.size, "slots_free": self.slots.free,
+                "running_jobs": held, **system_load(os.path.dirname(os.path.abspath(__file__)))}
+        resp = api_post(self.cfg, "/api/workers/heartbeat", body)
+        for key, reason, note in (("lost_jobs", "lost", "Lost lease"), ("cancel", "canceled", "Canceled by user")):
+            for job_id in resp.get(key, []):
+                with self._lock:
+                    control = self._held.get(job_id)
+                if control is not None and control.reason is None:
+                    print(f"⚠️ {note} on job {job_id}", flush=True)
+                    control.stop(reason, note)
+        return resp
+
+    def _run(self):
+        while True:
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"Heartbeat failed: {e}", flush=True)
+            time.sleep(self.interval)
+
+def build_image(context_dir, tag, control=None):
+    """Build ``tag`` from ``context_dir``; a stopped ``control`` aborts the build.
+
+    The CLI build is killed outright. The SDK build can only be abandoned
+    between output lines.
+    """
     dockerfile_path = os.path.join(context_dir, "Dockerfile")
     use_builtin = not os.path.exists(dockerfile_path)
     if use_builtin:
@@ -97,89 +842,460 @@ CMD ["python", "main.py"]
     if DOCKER_SDK:
         client = docker.from_env()
         # build generator stream
-        image, logs = client.images.build(path=context_dir, tag=tag, rm=True)
+        for chunk in client.api.build(path=context_dir, tag=tag, rm=True, decode=True):
+            if control is not None:
+                control.check()
+            if "error" in chunk:
+                raise RuntimeError(f"docker build failed: {chunk['error']}")
+            if "stream" in chunk:
+                print(chunk["stream"], end="")
     else:
         # fallback to CLI
         proc = subprocess.Popen(["docker", "build", "-t", tag, context_dir], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in iter(proc.stdout.readline, ''):
-            print(line, end='')
-        proc.wait()
+        with stopping(control, proc.kill):
+            for line in iter(proc.stdout.readline, ''):
+                print(line, end='')
+            proc.wait()
+        if control is not None:
+            control.check()
         if proc.returncode != 0:
             raise RuntimeError("docker build failed")
     return tag
 
-def upload_model_file(cfg, job_id, file_path):
-    print("uploading files to ")
-    url = urljoin(cfg["server_url"], f"/api/jobs/{job_id}/upload_model")
-    headers = {"Authorization": f"Bearer {cfg['token']}"}
-    
+# -------- Dependency image cache --------
+DEPS_DOCKERFILE = """FROM {base}
+WORKDIR /app
+COPY requirements.txt /tmp/requirements.txt
+RUN pip install --no-cache-dir -r /tmp/requirements.txt
+"""
+
+CODE_LAYER_DOCKERFILE = """FROM {deps}
+WORKDIR /app
+COPY . /app
+CMD ["python", "main.py"]
+"""
+
+def image_exists(tag):
+    if DOCKER_SDK:
+        try:
+            docker.from_env().images.get(tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+    return subprocess.run(["docker", "image", "inspect", tag], capture_output=True).returncode == 0
+
+def image_size(tag):
+    try:
+        if DOCKER_SDK:
+            return docker.from_env().images.get(tag).attrs.get("Size", 0)
+        out = subprocess.check_output(["docker", "image", "inspect", "-f", "{{.Size}}", tag], text=True)
+        return int(out.strip())
+    except Exception:
+        return 0
+
+def remove_image(tag):
+    """``docker rmi`` the tag and its now-unused parent layers. Returns True once it is gone."""
+    try:
+        if DOCKER_SDK:
+            client = docker.from_env()
+            # A stopped container still references its image, and rmi refuses to remove it
+            for container in client.containers.list(all=True, filters={"ancestor": tag, "status": ["exited", "created"]}):
+                container.remove()
+            client.images.remove(tag, noprune=False)
+        else:
+            stale = subprocess.check_output(["docker", "ps", "-aq", "--filter", f"ancestor={tag}",
+                                             "--filter", "status=exited", "--filter", "status=created"], text=True).split()
+            if stale:
+                subprocess.run(["docker", "rm", *stale], check=True, capture_output=True)
+            subprocess.run(["docker", "rmi", tag], check=True, capture_output=True)
+        return True
+    except Exception as e:
+        print(f"Could not remove image {tag}: {e}", flush=True)
+        return False
+
+def requirements_digest(base_image, requirements_path):
+    """Content hash of the base image + normalised requirements (comments, blanks and order ignored)."""
+    lines = []
+    if requirements_path and os.path.isfile(requirements_path):
+        with open(requirements_path, encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    lines.append(line)
+    h = hashlib.sha256(base_image.encode())
+    h.update(b"\0" + "\n".join(sorted(lines)).encode())
+    return h.hexdigest()
+
+class ImageCache:
+    """Content-addressed cache of dependency images, one per (base image, requirements) hash.
+
+    Jobs without their own Dockerfile run on ``dtrain-deps:<hash>`` with the
+    job code mounted (or layered) on top, so identical requirements are only
+    pip-installed once per host. Least recently used images are evicted once
+    the cache grows past ``image_cache_max_gb``; images in use are never evicted.
+    The LRU index is persisted in ``image_cache_index`` across agent restarts.
+    """
+
+    REPO = "dtrain-deps"
+
+    def __init__(self, cfg):
+        self.base_image = cfg.get("docker_base_image", "python:3.8")
+        self.max_bytes = int(cfg.get("image_cache_max_gb", 20) * 1024 ** 3)
+        self.index_path = cfg.get("image_cache_index") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_cache.json")
+        self._lock = threading.Lock()
+        self._build_locks = collections.defaultdict(threading.Lock)
+        self._in_use = collections.Counter()
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._index, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def acquire(self, requirements_path, control=None):
+        """Return the tag of a dependency image for these requirements, building it on a miss."""
+        digest = requirements_digest(self.base_image, requirements_path)
+        tag = f"{self.REPO}:{digest[:16]}"
+        with self._lock:
+            self._in_use[tag] += 1
+        try:
+            # One build per hash at a time; concurrent jobs with the same requirements wait for it
+            with self._build_locks[tag]:
+                if image_exists(tag):
+                    print(f"Dependency image cache hit: {tag}", flush=True)
+                else:
+                    print(f"Dependency image cache miss: building {tag}", flush=True)
+                    self._build(tag, requirements_path, control)
+        except Exception:
+            self.release(tag)
+            raise
+        size = self._index[tag]["size"] if tag in self._index else image_size(tag)
+        with self._lock:
+            self._index[tag] = {"size": size, "last_used": time.time()}
+            self._save_index()
+        self.evict()
+        return tag
+
+    def release(self, tag):
+        with self._lock:
+            self._in_use[tag] -= 1
+            if self._in_use[tag] <= 0:
+                del self._in_use[tag]
+
+    def _build(self, tag, requirements_path, control=None):
+        ctx = tempfile.mkdtemp(prefix="dtrain_deps_")
+        try:
+            dst = os.path.join(ctx, "requirements.txt")
+            if requirements_path and os.path.isfile(requirements_path):
+                shutil.copyfile(requirements_path, dst)
+            else:
+                open(dst, "w").close()
+            with open(os.path.join(ctx, "Dockerfile"), "w") as f:
+                f.write(DEPS_DOCKERFILE.format(base=self.base_image))
+            build_image(ctx, tag, control)
+        finally:
+            shutil.rmtree(ctx, ignore_errors=True)
+
+    def evict(self):
+        with self._lock:
+            total = sum(e.get("size", 0) for e in self._index.values())
+            for tag, entry in sorted(self._index.items(), key=lambda kv: kv[1].get("last_used", 0)):
+                if total <= self.max_bytes:
+                    break
+                if self._in_use.get(tag):
+                    continue
+                if remove_image(tag) or not image_exists(tag):
+                    total -= entry.get("size", 0)
+                    del self._index[tag]
+                    print(f"Evicted dependency image {tag}", flush=True)
+            self._save_index()
+
+def prepare_image(cfg, image_cache, job, workdir, control=None):
+    """Pick the image a job runs on. Returns (tag, code_dir to mount or None, deps tag to release or None)."""
+    job_tag = job.get("docker_image_tag") or f"mljob-{job['id']}:latest"
+    if os.path.exists(os.path.join(workdir, "Dockerfile")):
+        # Bundles that ship their own Dockerfile are built as-is
+        return build_image(workdir, job_tag, control), None, None
+    requirements = os.path.join(workdir, job.get("requirements_file") or "requirements.txt")
+    deps_tag = image_cache.acquire(requirements, control)
+    try:
+        if cfg.get("job_code_mode", "mount") == "layer":
+            with open(os.path.join(workdir, "Dockerfile"), "w") as f:
+                f.write(CODE_LAYER_DOCKERFILE.format(deps=deps_tag))
+            return build_image(workdir, job_tag, control), None, deps_tag
+        return deps_tag, workdir, deps_tag
+    except Exception:
+        image_cache.release(deps_tag)
+        raise
+
+def upload_model_file_legacy(cfg, job_id, file_path, name=None):
+    """Single multipart POST; only used against servers without chunked uploads."""
     with open(file_path, 'rb') as f:
-        files = {'file': (os.path.basename(file_path), f)}
-        r = requests.post(url, headers=headers, files=files, timeout=120)
+        files = {'file': (name or os.path.basename(file_path), f)}
+        r = http_client(cfg).request("POST", f"/api/jobs/{job_id}/upload_model", files=files, timeout=120)
         r.raise_for_status()
         return r.json()
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_model_file(cfg, job_id, file_path, name=None):
+    """Upload an artifact in chunks, resuming from the server's offset after failures.
+
+    init -> PUT chunk at offset ... -> complete (server verifies size + sha256).
+    A failed chunk is retried with backoff from whatever offset the server last
+    acknowledged, so a dropped connection never restarts a multi-GB upload.
+    """
+    base = f"/api/jobs/{job_id}/uploads"
+    http = http_client(cfg)
+    name = name or os.path.basename(file_path)
+    size = os.path.getsize(file_path)
+    sha256 = file_sha256(file_path)
+    try:
+        init = api_post(cfg, base, {"filename": name, "size": size, "sha256": sha256})
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in (404, 405):
+            return upload_model_file_legacy(cfg, job_id, file_path, name)
+        raise
+    upload_path = f"{base}/{init['upload_id']}"
+    headers = {"Content-Type": "application/octet-stream"}
+    if cfg.get("upload_chunk_mb"):
+        chunk_size = int(cfg["upload_chunk_mb"] * 1024 * 1024)
+    else:
+        chunk_size = init.get("chunk_size", 8 * 1024 * 1024)
+    max_retries = cfg.get("upload_max_retries", 8)
+
+    offset, failures = init.get("offset", 0), 0
+    with open(file_path, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            try:
+                r = http.request("PUT", upload_path, params={"offset": offset}, data=chunk, headers=headers, timeout=120)
+                if r.status_code == 409:
+                    # Server has a different view of how much it got; resync and carry on
+                    offset = r.json().get("offset", offset)
+                    continue
+                r.raise_for_status()
+                offset = r.json()["offset"]
+                failures = 0
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                failures += 1
+                if failures > max_retries:
+                    raise
+                delay = backoff_delay(failures, 1, 60)
+                print(f"Chunk upload of {os.path.basename(file_path)} failed at {offset}/{size} ({e}); retrying in {delay:.1f}s", flush=True)
+                time.sleep(delay)
+                try:
+                    offset = api_get(cfg, upload_path)["offset"]
+                except Exception:
+                    pass
+    return api_post(cfg, f"{upload_path}/complete", {"sha256": sha256}, timeout=600)
     
 
-def extract_model_files(container, workdir, model_patterns=None):
-    """Extract model files from container to local directory"""
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks (e.g. Docker's get_archive stream)."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+DEFAULT_MODEL_PATTERNS = ["*.pkl", "*.joblib", "*.h5", "*.pth", "*.pt", "model*"]
+
+def _is_model_file(name, model_patterns):
+    return any(fnmatch.fnmatch(name, p) for p in model_patterns)
+
+def _changed_app_files(container):
+    """Top-level /app files the job created or changed (``docker diff``; mounts never show up)."""
+    if DOCKER_SDK:
+        changes = [c["Path"] for c in container.diff() or [] if c["Kind"] in (0, 1)]
+    else:
+        out = subprocess.check_output(["docker", "diff", str(container)], text=True)
+        changes = [line[2:] for line in out.splitlines() if line[:1] in ("A", "C")]
+    return [path[len("/app/"):] for path in changes
+            if path.startswith("/app/") and "/" not in path[len("/app/"):]]
+
+def _copy_from_container(container, path, dst):
+    """Stream one regular file out of a (stopped) container; False if ``path`` isn't one."""
+    proc = None
+    try:
+        if DOCKER_SDK:
+            tar_stream, _ = container.get_archive(path)
+            fileobj = io.BufferedReader(ChunkStream(tar_stream), 1024 * 1024)
+        else:
+            # `docker cp <container>:<path> -` writes a tar stream to stdout
+            proc = subprocess.Popen(["docker", "cp", f"{container}:{path}", "-"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            fileobj = proc.stdout
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    return False
+                with tar.extractfile(member) as src, open(dst, "wb") as out:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+                return True
+        return False
+    finally:
+        if proc is not None:
+            proc.stdout.close()
+            proc.wait()
+
+def extract_model_files(container, workdir, model_patterns=None, code_dir=None):
+    """Collect model files saved at the top of the container's /app into workdir.
+
+    When the job code was mounted (``code_dir``) the files are already on the
+    host and are simply moved. Otherwise ``docker diff`` lists what the job
+    wrote to /app and only the matching files are copied out one by one, so
+    mounted outputs, datasets and the rest of the code tree are never read.
+    """
     if model_patterns is None:
-        model_patterns = ["*.pkl", "*.joblib", "*.h5", "*.pth", "*.pt", "model*"]
+        model_patterns = DEFAULT_MODEL_PATTERNS
     
     extracted_files = []
-    
-    if DOCKER_SDK:
-        # Using Docker SDK
-        for pattern in model_patterns:
-            try:
-                # Get files from container
-                tar_stream, _ = container.get_archive(f'/app/{pattern}')
-                # Extract to workdir
-                with tempfile.NamedTemporaryFile() as tmp:
-                    for chunk in tar_stream:
-                        tmp.write(chunk)
-                    tmp.flush()
-                    
-                    with tarfile.open(tmp.name, 'r') as tar:
-                        tar.extractall(workdir)
-                        extracted_files.extend([os.path.join(workdir, name) for name in tar.getnames()])
-            except Exception:
-                continue  # Pattern not found, try next
-    else:
-        # Using CLI - copy files out of container
-        for pattern in model_patterns:
-            try:
-                subprocess.run([
-                    "docker", "cp", f"{container}:/app/{pattern}", workdir
-                ], check=False, capture_output=True)  # Don't fail if pattern doesn't match
-                
-                # Check what files were copied
-                for f in os.listdir(workdir):
-                    if any(f.endswith(ext.replace('*', '')) for ext in model_patterns):
-                        extracted_files.append(os.path.join(workdir, f))
-            except Exception:
-                continue
+    try:
+        if code_dir:
+            for entry in os.scandir(code_dir):
+                if entry.is_file(follow_symlinks=False) and _is_model_file(entry.name, model_patterns):
+                    dst = os.path.join(workdir, entry.name)
+                    shutil.move(entry.path, dst)
+                    extracted_files.append(dst)
+        else:
+            for name in _changed_app_files(container):
+                if not _is_model_file(name, model_patterns):
+                    continue
+                dst = os.path.join(workdir, name)
+                if _copy_from_container(container, f"/app/{name}", dst):
+                    extracted_files.append(dst)
+    except Exception as e:
+        print(f"Could not extract model files from container: {e}", flush=True)
     
     return extracted_files
 
-def run_container(tag, main_entry="main.py", env=None, network=None):
+class ArtifactCollector:
+    """Uploads every file in a job's outputs directory, ``upload_parallelism`` at a time.
+
+    Uploads go through the agent's pooled HttpClient so parallel chunk PUTs
+    reuse connections, and each file is streamed chunk by chunk from disk.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.parallelism = max(1, cfg.get("upload_parallelism", 4))
+
+    def collect(self, job_id, outputs_dir):
+        """Upload all files under ``outputs_dir``; returns (uploaded names, failed names)."""
+        files = []
+        for root, _, names in os.walk(outputs_dir):
+            for fname in names:
+                files.append(os.path.join(root, fname))
+        uploaded, failed = [], []
+        if not files:
+            return uploaded, failed
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.parallelism, len(files)),
+                                                   thread_name_prefix=f"upload-{job_id}") as pool:
+            futures = {
+                pool.submit(upload_model_file, self.cfg, job_id, path, os.path.relpath(path, outputs_dir)): path
+                for path in files
+            }
+            for fut in concurrent.futures.as_completed(futures):
+                path = futures[fut]
+                name = os.path.relpath(path, outputs_dir)
+                try:
+                    res = fut.result()
+                    print(f"✅ Uploaded {name} -> {res.get('filename')}", flush=True)
+                    os.remove(path)
+                    uploaded.append(name)
+                except Exception as e:
+                    print(f"❌ Failed to upload {name}: {e}", flush=True)
+                    failed.append(name)
+        return uploaded, failed
+
+def total_memory_bytes():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def container_limits(cfg, job=None):
+    """Per-container (cpus, memory bytes) limits.
+
+    A job's declared resource requests win (the scheduler only placed it here
+    because they fit); otherwise the configured limits, or an even share of
+    the host per slot.
+    """
+    declared = dict((job or {}).get("resources") or {})
+    if not math.isfinite(declared.get("cpus") or 0):
+        declared["cpus"] = None  # jobs queued before the server rejected inf/nan
+    if declared.get("cpus") or declared.get("memory_mb"):
+        cpus = declared.get("cpus") or cfg.get("container_cpus")
+        mem = declared.get("memory_mb") or cfg.get("container_memory_mb")
+        return cpus, int(mem) * 1024 * 1024 if mem else None
+    slots = max(1, cfg.get("max_concurrent_jobs", 1))
+    cpus = cfg.get("container_cpus")
+    if cpus is None and slots > 1:
+        cpus = round((os.cpu_count() or 1) / slots, 2)
+    mem = cfg.get("container_memory_mb")
+    if mem is not None:
+        mem = int(mem) * 1024 * 1024
+    elif slots > 1 and total_memory_bytes():
+        # Leave ~10% of the host for the agent and the Docker daemon
+        mem = int(total_memory_bytes() * 0.9 / slots)
+    return cpus, mem
+
+def run_container(tag, main_entry="main.py", env=None, network=None, outputs_dir=None, cpus=None, mem_limit=None, code_dir=None):
     env_list = [f"{k}={v}" for k,v in (env or {}).items()]
     cmd = ["python", main_entry]
 
     # Ensure local outputs dir exists
-    outputs_dir = os.path.abspath("outputs")
+    outputs_dir = os.path.abspath(outputs_dir or "outputs")
     os.makedirs(outputs_dir, exist_ok=True)
 
+    # Job code mounted over the cached dependency image (outputs stays a nested mount)
+    volumes = {}
+    if code_dir:
+        volumes[os.path.abspath(code_dir)] = {"bind": "/app", "mode": "rw"}
+    volumes[outputs_dir] = {"bind": "/app/outputs", "mode": "rw"}
+
     if DOCKER_SDK:
         client = docker.from_env()
+        limits = {}
+        if cpus:
+            limits["nano_cpus"] = int(cpus * 1e9)
+        if mem_limit:
+            limits["mem_limit"] = mem_limit
         container = client.containers.run(
             tag,
             cmd,
             detach=True,
             environment=env or {},
             network=network,
-            volumes={
-                outputs_dir: {"bind": "/app/outputs", "mode": "rw"}
-            }
+            volumes=volumes,
+            **limits
         )
         return container
     else:
@@ -188,106 +1304,256 @@ def run_container(tag, main_entry="main.py", env=None, network=None):
             args += ["-e", e]
         if network:
             args += ["--network", network]
+        if cpus:
+            args += ["--cpus", str(cpus)]
+        if mem_limit:
+            args += ["--memory", str(mem_limit)]
 
-        # mount outputs folder
-        args += ["-v", f"{outputs_dir}:/app/outputs"]
+        # mount job code and outputs folder
+        for host_path, spec in volumes.items():
+            args += ["-v", f"{host_path}:{spec['bind']}:{spec['mode']}"]
 
         args += [tag] + cmd
         cid = subprocess.check_output(args, text=True).strip()
         return cid
 
         
-def stream_logs(container, job_id, cfg):
+def stop_container(container, grace_sec=10):
+    """SIGTERM the container, SIGKILL after ``grace_sec``; its log stream then ends."""
     if DOCKER_SDK:
-        for line in container.logs(stream=True, follow=True):
-            print(line, flush=True)
-            send_logs(cfg, job_id, [line.decode('utf-8', errors='ignore').rstrip()])
+        container.stop(timeout=grace_sec)
     else:
-        proc = subprocess.Popen(["docker", "logs", "-f", str(container)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True)
-        for line in iter(proc.stdout.readline, ''):
-            send_logs(cfg, job_id, [line.rstrip()])
-        proc.wait()
+        subprocess.run(["docker", "stop", "-t", str(grace_sec), str(container)], check=True, capture_output=True)
+
+def remove_container(container):
+    """Delete a finished job container so it no longer pins its image."""
+    try:
+        if DOCKER_SDK:
+            container.remove(force=True)
+        else:
+            subprocess.run(["docker", "rm", "-f", str(container)], check=True, capture_output=True)
+    except Exception as e:
+        print(f"Could not remove container {container}: {e}", flush=True)
+
+def stream_logs(container, job_id, cfg, control=None):
+    shipper = LogShipper(cfg, job_id, control).start()
+    parser = MetricParser(cfg)
+    metrics = MetricShipper(cfg, job_id).start()
+
+    def handle(line):
+        shipper.add(line)
+        point = parser.parse(line)
+        if point is not None:
+            metrics.add(point)
+
+    try:
+        if DOCKER_SDK:
+            for line in container.logs(stream=True, follow=True):
+                print(line, flush=True)
+                handle(line.decode('utf-8', errors='ignore').rstrip())
+        else:
+            proc = subprocess.Popen(["docker", "logs", "-f", str(container)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True)
+            for line in iter(proc.stdout.readline, ''):
+                handle(line.rstrip())
+            proc.wait()
+    finally:
+        shipper.close()
+        metrics.close()
 # def upload_to_cloudinary(file_path):
 #         result = cloudinary.uploader.upload(file_path, resource_type="raw")
 #         return result["public_id"], result["secure_url"]
+class JobSlots:
+    """Fixed pool of ``max_concurrent_jobs`` slots; each running job gets its own thread."""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._sem = threading.Semaphore(self.size)
+        self._lock = threading.Lock()
+        self.running = {}
+
+    @property
+    def free(self):
+        with self._lock:
+            return self.size - len(self.running)
+
+    def wait_for_slot(self):
+        self._sem.acquire()
+
+    def give_back(self):
+        """Return a slot taken with ``wait_for_slot`` that ended up unused."""
+        self._sem.release()
+
+    def start(self, job_id, target, *args):
+        def run():
+            try:
+                target(*args)
+            finally:
+                with self._lock:
+                    self.running.pop(job_id, None)
+                self._sem.release()
+
+        thread = threading.Thread(target=run, name=f"job-{job_id}", daemon=True)
+        with self._lock:
+            self.running[job_id] = thread
+        thread.start()
+
+# Long-lived helpers shared by every job the agent runs
+WorkerContext = collections.namedtuple("WorkerContext", "slots heartbeat image_cache bundle_cache collector")
+
+# Server status reported for a job stopped early; a lost job is no longer ours to report on
+STOP_STATUSES = {"canceled": "canceled", "timeout": "failed", "build_timeout": "failed"}
+
+def run_job(cfg, job, ctx, control=None):
+    """Download, build, run and collect one claimed job. Runs in its slot's thread.
+
+    The image build is bounded by the job's ``build_timeout_sec`` (else
+    ``docker_build_timeout_sec``) and the container run by its ``timeout_sec``
+    (else ``job_timeout_sec``). On a timeout or cancellation the container is
+    stopped, artifacts are skipped and the slot is freed right away.
+    """
+    job_id = job["id"]
+    control = control or JobControl(job_id)
+    build_timeout = job.get("build_timeout_sec") or cfg.get("docker_build_timeout_sec", 1800)
+    run_timeout = job.get("timeout_sec") or cfg.get("job_timeout_sec")
+    image_cache = ctx.image_cache
+    deps_tag = job_image = container = None
+    tmpdir = tempfile.mkdtemp(prefix=f"job_{job_id}_")
+    # Per-job outputs so concurrent jobs on this host don't clobber each other
+    outputs_dir = os.path.abspath(os.path.join("outputs", f"job_{job_id}"))
+    outcome = "completed"
+    try:
+        with job_phase("download"):
+            bundle_zip = ctx.bundle_cache.fetch(cfg, job)
+        workdir = os.path.join(tmpdir, "context")
+        os.makedirs(workdir, exist_ok=True)
+        with job_phase("extract"):
+            decompress(bundle_zip, workdir, max_files=int(cfg.get("bundle_max_files", 10000)),
+                       max_bytes=int(cfg.get("bundle_max_uncompressed_mb", 4096)) * 1024 * 1024)
+        control.check()
+        post_status(cfg, job_id, "running", "Building Docker image")
+        timer = control.deadline(build_timeout, "build_timeout", f"Image build timed out after {build_timeout}s")
+        try:
+            with job_phase("build"):
+                tag, code_dir, deps_tag = prepare_image(cfg, image_cache, job, workdir, control)
+                job_image = tag if tag != deps_tag else None  # built just for this job
+        finally:
+            timer.cancel()
+        control.check()
+        post_status(cfg, job_id, "running", "Starting container")
+        cpus, mem_limit = container_limits(cfg, job)
+        with job_phase("run"):
+            container = run_container(tag, main_entry=job.get("main_entry","main.py"), env=cfg.get("docker_run_env") or {},
+                                      network=cfg.get("docker_network"), outputs_dir=outputs_dir, cpus=cpus,
+                                      mem_limit=mem_limit, code_dir=code_dir)
+            post_status(cfg, job_id, "running", "Streaming logs")
+            timer = control.deadline(run_timeout, "timeout", f"Timed out after {run_timeout}s") if run_timeout else None
+            try:
+                with control.stopping(lambda: stop_container(container, cfg.get("container_stop_grace_sec", 10))):
+                    stream_logs(container, job_id, cfg, control)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        control.check()
+        # The server releases the lease on a terminal status: stop heartbeating the
+        # job first, or the next beat reports it lost while artifacts still upload
+        ctx.heartbeat.drop(job_id)
+        post_status(cfg, job_id, "completed", "Container finished")
+
+        with job_phase("upload"):
+            # Model files saved next to the code (/app/*.pkl ...) join the job's outputs/
+            if cfg.get("collect_app_models", True):
+                extract_model_files(container, outputs_dir, cfg.get("model_patterns"), code_dir)
+            uploaded, failed = ctx.collector.collect(job_id, outputs_dir)
+        if failed:
+            send_logs(cfg, job_id, [f"[WORKER] Failed to upload {len(failed)} artifact(s): {', '.join(failed)}"])
+    except Exception as e:
+        # A killed build or container also surfaces here; report why it was stopped instead
+        outcome = control.reason or "failed"
+        if control.reason == "lost":
+            print(f"Job {job_id} abandoned: lease lost")
+        else:
+            status = STOP_STATUSES.get(control.reason, "failed")
+            note = control.note or str(e)
+            print(f"Job {job_id} {status}: {note}")
+            send_logs(cfg, job_id, [f"[WORKER] {note}" if control.reason else f"[WORKER ERROR] {e}"])
+            try:
+                post_status(cfg, job_id, status, note)
+            except Exception:
+                pass
+    finally:
+        if JOBS_FINISHED is not None:
+            JOBS_FINISHED.labels(outcome).inc()
+        ctx.heartbeat.drop(job_id)
+        # Containers and per-job images otherwise keep the cached dependency
+        # layers referenced, and eviction could never free their disk space
+        if container is not None:
+            remove_container(container)
+        if job_image:
+            remove_image(job_image)
+        if deps_tag:
+            image_cache.release(deps_tag)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        shutil.rmtree(outputs_dir, ignore_errors=True)
+
 def main():
     cfg = load_config()
+    slots = JobSlots(cfg.get("max_concurrent_jobs", 1))
+    heartbeat = Heartbeat(cfg, slots)
+    ctx = WorkerContext(slots, heartbeat, ImageCache(cfg), BundleCache(cfg), ArtifactCollector(cfg))
+    threading.Thread(target=report_http_stats, args=(cfg,), name="http-stats", daemon=True).start()
+    start_exporter(cfg, slots)
     # Register worker
     try:
-        api_post(cfg, "/api/workers/register", {"name": cfg["worker_name"]})
+        api_post(cfg, "/api/workers/register", {"name": cfg["worker_name"], "slots_total": slots.size, "slots_free": slots.free})
     except Exception as e:
         print(f"Register failed: {e}")
+    heartbeat.start()
+    poll_base = cfg.get("poll_interval_sec", 5)
+    poll_cap = cfg.get("poll_max_interval_sec", 60)
+    idle_polls = 0
     while True:
+        # Only ask for work when a slot is free
+        slots.wait_for_slot()
+
+        # The server atomically leases the next job to us, holding the request
+        # open until one arrives. If it returns early (error, or an old server
+        # without long-poll) fall back to polling with jittered backoff.
+        started = time.monotonic()
         try:
-            pending = api_get(cfg, "/api/jobs/pending")
+            job = claim_job(cfg, slots)
         except Exception as e:
-            print(f"Poll failed: {e}")
-            time.sleep(cfg.get("poll_interval_sec", 5))
+            slots.give_back()
+            print(f"Claim failed: {e}")
+            time.sleep(backoff_delay(idle_polls, poll_base, poll_cap))
+            idle_polls += 1
             continue
 
-        if not pending:
+        if not job:
+            slots.give_back()
             print("⏳ No pending jobs... waiting")
-            time.sleep(cfg.get("poll_interval_sec", 5))
+            if time.monotonic() - started < cfg.get("claim_wait_sec", 25) / 2:
+                time.sleep(backoff_delay(idle_polls, poll_base, poll_cap))
+                idle_polls += 1
             continue
 
-        job = pending[0]
+        idle_polls = 0
         job_id = job["id"]
-        
-        # Ask user for manual acceptance
-        if not ask_user_acceptance(job):
+        control = heartbeat.hold(job_id)
+
+        # Ask user for manual acceptance unless configured to take everything
+        if not cfg.get("auto_accept_jobs", False) and not ask_user_acceptance(job):
+            slots.give_back()
             print("❌ Job rejected by user")
-            time.sleep(cfg.get("poll_interval_sec", 5))
-            continue
-            
-        print(f"✅ Accepting job {job_id} ...")
-        try:
-            api_post(cfg, f"/api/jobs/{job_id}/accept", {"worker_name": cfg["worker_name"]})
-        except Exception as e:
-            print(f"❌ Accept failed: {e}")
-            time.sleep(cfg.get("poll_interval_sec", 5))
+            heartbeat.drop(job_id)
+            try:
+                api_post(cfg, f"/api/jobs/{job_id}/release", {"worker_name": cfg["worker_name"]})
+            except Exception as e:
+                print(f"Release failed: {e}")
+            time.sleep(poll_base)
             continue
 
-        # Download
-        tmpdir = tempfile.mkdtemp(prefix=f"job_{job_id}_")
-        bundle_zip = os.path.join(tmpdir, "bundle.zip")
-        try:
-            download_job_by_id(cfg, job_id, bundle_zip)
-            workdir = os.path.join(tmpdir, "context")
-            os.makedirs(workdir, exist_ok=True)
-            decompress(bundle_zip, workdir)
-            tag = job.get("docker_image_tag") or f"mljob-{job_id}:latest"
-            api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"running", "note": "Building Docker image"})
-            build_image(workdir, tag)
-            api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"running", "note": "Starting container"})
-            container = run_container(tag, main_entry=job.get("main_entry","main.py"), env=cfg.get("docker_run_env") or {}, network=cfg.get("docker_network"))
-            api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"running", "note": "Streaming logs"})
-            stream_logs(container, job_id, cfg)
-            api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"completed", "note": "Container finished"})
-            api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"completed", "note": "Container finished"})
-
-# Look for generated files in outputs/
-            outputs_dir = os.path.abspath("outputs")
-            print("output dir = " + outputs_dir)
-            for fname in os.listdir(outputs_dir):
-                fpath = os.path.join(outputs_dir, fname)
-                if os.path.isfile(fpath):
-                    try:
-                        res = upload_model_file(cfg, job_id, fpath)
-                        print(f"✅ Uploaded {fname} -> {res}")
-                        print("removing the file after this: ")
-                        os.remove(fpath)
-                        print("successfully removed: ")
-                    except Exception as e:
-                        print(f"❌ Failed to upload {fname}: {e}")
-        except Exception as e:
-            print(f"Job {job_id} failed: {e}")
-            send_logs(cfg, job_id, [f"[WORKER ERROR] {e}"])
-            try:
-                api_post(cfg, f"/api/jobs/{job_id}/status", {"status":"failed", "note": str(e)})
-            except Exception:
-                pass
-        finally:
-            shutil.rmtree(tmpdir, ignore_errors=True)
+        print(f"✅ Accepted job {job_id} ({slots.free - 1}/{slots.size} slots left after this one)")
+        slots.start(job_id, run_job, cfg, job, ctx, control)
 
 if __name__ == "__main__":
     main()